@@ -2,10 +2,19 @@ import streamlit as st
 import google.generativeai as genai
 import tempfile
 import os
-import subprocess
+import asyncio
 import time
 import re
+import uuid
+import signal
+import threading
+import collections
+import sqlite3
+import hashlib
+import json
 import requests
+import numpy as np
+from PIL import ImageFont
 from pathlib import Path
 
 # --- 1. 页面配置 ---
@@ -58,22 +67,305 @@ st.markdown("""
 
 # --- 3. 核心功能：SRT 转 ASS (带颜色) ---
 
-def time_srt_to_ass(srt_time):
-    """将 SRT 时间格式 (00:00:00,000) 转换为 ASS 时间格式 (0:00:00.00)"""
+def seconds_to_ass_time(seconds):
+    """秒 -> ASS 时间格式 (0:00:00.00)，ASS 只精确到百分之一秒"""
+    total_cs = max(int(seconds * 100), 0)
+    h, rest = divmod(total_cs, 360_000)
+    m, rest = divmod(rest, 6_000)
+    s, cs = divmod(rest, 100)
+    return f"{h}:{m:02d}:{s:02d}.{cs:02d}"
+
+def srt_time_to_seconds(srt_time):
+    """SRT 时间 (00:00:00,000) -> 秒 (float)，解析失败返回 None"""
     try:
-        h, m, s_ms = srt_time.split(':')
+        h, m, s_ms = srt_time.strip().replace('.', ',').split(':')
         s, ms = s_ms.split(',')
-        # ASS 只需要两位毫秒
-        return f"{int(h)}:{m}:{s}.{ms[:2]}"
+        return int(h) * 3600 + int(m) * 60 + int(s) + int(ms.ljust(3, '0')[:3]) / 1000
     except:
-        return "0:00:00.00"
+        return None
+
+def seconds_to_srt_time(seconds):
+    """秒 -> SRT 时间 (00:00:00,000)"""
+    total_ms = max(int(round(seconds * 1000)), 0)
+    h, rest = divmod(total_ms, 3600_000)
+    m, rest = divmod(rest, 60_000)
+    s, ms = divmod(rest, 1000)
+    return f"{h:02d}:{m:02d}:{s:02d},{ms:03d}"
+
+def parse_srt_cues(srt_content):
+    """解析 SRT -> [(start_s, end_s, text)]，跳过格式不对的块"""
+    cues = []
+    for block in re.split(r'\n\s*\n', srt_content.strip()):
+        lines = block.strip().split('\n')
+        if len(lines) < 3:
+            continue
+        times = lines[1].split(' --> ')
+        if len(times) != 2:
+            continue
+        start, end = srt_time_to_seconds(times[0]), srt_time_to_seconds(times[1])
+        if start is None or end is None:
+            continue
+        cues.append((start, end, "\n".join(line.strip() for line in lines[2:])))
+    return cues
+
+def format_srt_cues(cues):
+    """[(start_s, end_s, text)] -> SRT 文本 (重新编号)"""
+    return "\n".join(
+        f"{i}\n{seconds_to_srt_time(start)} --> {seconds_to_srt_time(end)}\n{text}\n"
+        for i, (start, end, text) in enumerate(cues, 1)
+    )
+
+# --- 3.1 字幕排版：按真实字体宽度断行、按说话人/标点拆分字幕 ---
+
+ASS_PLAY_RES_X = 384     # ASS 坐标系默认 4:3 (libass 默认值)，纯音频/探测失败时使用
+ASS_PLAY_RES_Y = 288     # 高度固定，宽度按视频宽高比算，字号和边距才与画面比例一致
+ASS_FONT_SIZE = 20
+ASS_MARGIN_H = 10        # 左右边距 (与样式里的 MarginL/MarginR 一致)
+LAYOUT_MAX_LINES = 2     # 每条字幕最多两行
+LAYOUT_MAX_CPS = 9       # 阅读速度上限：每秒 9 个汉字 (西文按半个字计)
+LAYOUT_MIN_SECONDS = 0.8 # 拆分后每条字幕至少显示这么久
+
+_CJK_RE = re.compile(r'[\u2E80-\u9FFF\uF900-\uFAFF\uFF00-\uFFEF\u3000-\u303F]')
+# 行首禁则：这些标点不能出现在行首 / 行尾
+_NO_LINE_START = set("，。！？、；：”’）》」』】〉…,.!?;:)]}%")
+_NO_LINE_END = set("“‘（《「『【〈([{")
+_SENTENCE_END = set("。！？!?…；;")
+_CLAUSE_END = set("，、,：:")
+_IDEOGRAPH_RE = re.compile(r'[\u2E80-\u2FFF\u3040-\u9FFF\uF900-\uFAFF]')
+_ALNUM_RE = re.compile(r'[A-Za-z0-9\u00C0-\u024F\uFF10-\uFF5A]')
+_DIALOGUE_DASH_RE = re.compile(rf'(?<=[{re.escape("".join(sorted(_SENTENCE_END)))}])\s*-\s*')
+_SPEAKER_PREFIX_RE = re.compile(r'^([^:：\n]{1,20}?)\s*[:：]')
+_BREAK_TOKEN_RE = re.compile(r'\s+|[^\s\u2E80-\u9FFF\uF900-\uFAFF\uFF00-\uFFEF\u3000-\u303F]+|.')
+
+class FontMetrics:
+    """按字符缓存字宽，整行宽度 = 字宽之和 (中文字幕不需要考虑字距调整)"""
+
+    def __init__(self, font_path, font_size):
+        self.font_size = font_size
+        self._widths = {}
+        try:
+            self._font = ImageFont.truetype(font_path, font_size) if font_path else None
+        except Exception:
+            # 字体下载失败时退化为估算：全角 = 字号，半角 = 半个字号
+            self._font = None
+
+    def char_width(self, char):
+        width = self._widths.get(char)
+        if width is None:
+            if self._font is not None:
+                width = self._font.getlength(char)
+            else:
+                width = self.font_size * (1.0 if _CJK_RE.match(char) else 0.5)
+            self._widths[char] = width
+        return width
+
+    def width(self, text):
+        width = self._widths.get(text)
+        if width is None:
+            width = sum(map(self.char_width, text))
+            # 单词/带标点的字这类短单元也缓存，整行不缓存
+            if len(text) <= 12:
+                self._widths[text] = width
+        return width
+
+@st.cache_resource
+def get_font_metrics(font_path, font_size):
+    """同一字体+字号的字宽缓存在所有会话、所有任务之间共享"""
+    return FontMetrics(font_path, font_size)
 
-def convert_srt_to_ass_colored(srt_content, role_1_cn, role_2_cn):
+def reading_length(text):
+    """阅读长度：汉字算 1，西文/数字算 0.5，空白和标点不计"""
+    return len(_IDEOGRAPH_RE.findall(text)) + 0.5 * len(_ALNUM_RE.findall(text))
+
+def _join_lines(lines):
+    """合并 SRT 的多行文本：中文之间直接拼接，西文之间补空格"""
+    text = ""
+    for line in (l.strip() for l in lines):
+        if not line:
+            continue
+        if text and not (_CJK_RE.match(text[-1]) or _CJK_RE.match(line[0])):
+            text += " "
+        text += line
+    return text
+
+def _break_units(text):
+    """切成不可再分的排版单元：西文单词整体、汉字逐字，标点粘在相邻字上"""
+    units = []
+    pending_open = ""
+    for token in _BREAK_TOKEN_RE.findall(text):
+        if token.isspace():
+            units.append(" ")
+        elif token in _NO_LINE_END:
+            pending_open += token
+        elif token[0] in _NO_LINE_START and units and units[-1] != " ":
+            units[-1] += token
+        else:
+            units.append(pending_open + token)
+            pending_open = ""
+    if pending_open:
+        units.append(pending_open)
+    return units
+
+def break_lines(text, metrics, max_width):
+    """
+    在 max_width 内断行，返回行列表
+    两行的情况会在所有断点中挑最均衡的一个 (优先在标点后断开)
+    """
+    total = metrics.width(text)
+    if total <= max_width:
+        return [text]
+    units = _break_units(text)
+    widths = [metrics.width(u) for u in units]
+
+    # 两行放得下：在所有断点中挑最均衡的，标点后断开加分
+    if total <= 2 * max_width:
+        best, best_cost, prefix = None, None, 0.0
+        for i in range(1, len(units)):
+            prefix += widths[i - 1]
+            first, second = prefix, total - prefix
+            if first > max_width or second > max_width:
+                continue
+            cost = max(first, second)
+            if units[i - 1][-1] in _SENTENCE_END or units[i - 1][-1] in _CLAUSE_END:
+                cost -= 0.15 * max_width
+            if best_cost is None or cost < best_cost:
+                best, best_cost = i, cost
+        if best is not None:
+            return ["".join(units[:best]).strip(), "".join(units[best:]).strip()]
+
+    # 贪心断行
+    lines, current, current_width = [], [], 0.0
+    for unit, width in zip(units, widths):
+        if current and current_width + width > max_width and unit != " ":
+            lines.append(current)
+            current, current_width = [], 0.0
+        if unit == " " and not current:
+            continue
+        current.append(unit)
+        current_width += width
+    if current:
+        lines.append(current)
+    return ["".join(line).strip() for line in lines]
+
+def _split_by_speaker(raw_text, speakers):
+    """
+    按 "名字:" 前缀或对话破折号把一条 SRT 字幕拆成多个说话人片段
+    破折号只在行首或句末标点之后才算换人 ("Wi-Fi"、"好 - 吧" 不拆)
+    """
+    # 以 "-" 开头的行开始新的说话人，其余行并入上一段
+    groups = []
+    for line in raw_text.split("\n"):
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("-") or not groups:
+            groups.append([line.lstrip("-").strip()])
+        else:
+            groups[-1].append(line)
+
+    names = "|".join(re.escape(name) for name in speakers if name)
+    pattern = _DIALOGUE_DASH_RE.pattern + (rf'|(?=(?:{names})\s*[:：])' if names else "")
+    parts = []
+    for group in groups:
+        parts += re.split(pattern, _join_lines(group))
+    return [part.strip() for part in parts if part and part.strip()]
+
+def speaker_prefix(text):
+    """字幕开头的 "名字:" / "名字：" 前缀里的名字，没有前缀返回 None"""
+    match = _SPEAKER_PREFIX_RE.match(text.strip())
+    return match.group(1).strip() if match else None
+
+def _split_to_fit(text, metrics, max_width):
+    """一段话放不进 LAYOUT_MAX_LINES 行时，优先在句末、其次在逗号处拆成多段"""
+    capacity = LAYOUT_MAX_LINES * max_width
+    if metrics.width(text) <= capacity * 0.9:
+        return [text]
+
+    for boundaries in (_SENTENCE_END, _SENTENCE_END | _CLAUSE_END):
+        clauses, current = [], ""
+        for c in text:
+            current += c
+            if c in boundaries:
+                clauses.append(current)
+                current = ""
+        if current:
+            clauses.append(current)
+        if len(clauses) < 2:
+            continue
+        pieces, current = [], ""
+        for clause in clauses:
+            # 不要把 "名字：" 前缀单独拆成一条
+            if current and not _SPEAKER_PREFIX_RE.fullmatch(current.strip()) and metrics.width(current + clause) > capacity * 0.9:
+                pieces.append(current)
+                current = clause
+            else:
+                current += clause
+        pieces.append(current)
+        if all(len(break_lines(p, metrics, max_width)) <= LAYOUT_MAX_LINES for p in pieces):
+            return [p.strip() for p in pieces if p.strip()]
+
+    # 没有合适的标点：按行硬拆
+    lines = break_lines(text, metrics, max_width)
+    return [_join_lines(lines[i:i + LAYOUT_MAX_LINES]) for i in range(0, len(lines), LAYOUT_MAX_LINES)]
+
+def layout_cues(cues, speakers, metrics, max_width):
+    """
+    对 [(start_s, end_s, text)] 排版，返回 [(start_s, end_s, [line, ...], speaker)]
+    - speaker 取自说话人片段开头的 "名字:" 前缀 (没有则为 None)，长句拆出的后续几段沿用
+    - 多个说话人的字幕按说话人拆开，太长的在标点处拆开，时间按阅读长度比例分配
+    - 每段按真实字宽断行 (ASS 里用 \\N 连接)
+    - 超过阅读速度的字幕向后延长，但不压到下一条
+    """
+    laid_out = []
+    for start, end, raw_text in cues:
+        segments = _split_by_speaker(raw_text, speakers)
+        if not segments:
+            continue
+
+        duration = max(end - start, 0.0)
+        # 不同说话人一定拆开 (颜色不同)；同一人的长句在标点处拆，
+        # 但拆得太碎、每段时长不够读时，这一段退回不拆 (只断行)
+        segment_weights = [max(reading_length(seg), 0.5) for seg in segments]
+        segment_total = sum(segment_weights)
+        pieces = []
+        for segment, weight in zip(segments, segment_weights):
+            split = _split_to_fit(segment, metrics, max_width)
+            if len(split) > 1 and duration * weight / segment_total / len(split) < LAYOUT_MIN_SECONDS:
+                split = [segment]
+            speaker = speaker_prefix(segment)
+            pieces += [(piece, speaker) for piece in split]
+        weights = [max(reading_length(p), 0.5) for p, _ in pieces]
+        total = sum(weights)
+        cursor = start
+        for (piece, speaker), weight in zip(pieces, weights):
+            piece_end = cursor + duration * weight / total
+            laid_out.append([cursor, piece_end, break_lines(piece, metrics, max_width), speaker])
+            cursor = piece_end
+
+    laid_out.sort(key=lambda cue: cue[0])
+    for i, cue in enumerate(laid_out):
+        needed = reading_length("".join(cue[2])) / LAYOUT_MAX_CPS
+        if cue[1] - cue[0] < needed:
+            limit = laid_out[i + 1][0] if i + 1 < len(laid_out) else cue[0] + needed
+            cue[1] = max(cue[1], min(cue[0] + needed, limit))
+    return [tuple(cue) for cue in laid_out]
+
+def ass_play_res_x(video_size):
+    """按视频宽高比计算 PlayResX (PlayResY 固定为 ASS_PLAY_RES_Y)"""
+    if not video_size:
+        return ASS_PLAY_RES_X
+    width, height = video_size
+    return max(int(round(ASS_PLAY_RES_Y * width / height)), 2 * ASS_MARGIN_H + ASS_FONT_SIZE)
+
+def convert_srt_to_ass_colored(srt_content, role_1_cn, role_2_cn, font_path=None, metrics=None, play_res_x=ASS_PLAY_RES_X):
     """
     将 SRT 字幕转换为带有角色颜色的 ASS 字幕
     Ling (Role 1) -> Blue
     Orm (Role 2) -> Pink
     Others -> White
+    font_path: 用于测量字宽的字体文件，缺省时按全角/半角估算
+    metrics: 已经取好的 FontMetrics (在事件循环里调用时由会话线程传入)
+    play_res_x: 与视频宽高比一致的画布宽度 (见 ass_play_res_x)，断行宽度也按它计算
     """
     
     # ASS 颜色代码是 BGR 顺序 (Blue, Green, Red)
@@ -92,49 +384,45 @@ def convert_srt_to_ass_colored(srt_content, role_1_cn, role_2_cn):
 Title: LingOrm Subtitles
 ScriptType: v4.00+
 WrapStyle: 0
+PlayResX: {play_res_x}
+PlayResY: {ASS_PLAY_RES_Y}
 ScaledBorderAndShadow: yes
 YCbCr Matrix: None
 
 [V4+ Styles]
 Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
-Style: Default,WenQuanYi Micro Hei,20,{COLOR_WHITE},&H000000FF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,1,1,0,2,10,10,20,1
-Style: LingStyle,WenQuanYi Micro Hei,20,{COLOR_BLUE},&H000000FF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,1,1,0,2,10,10,20,1
-Style: OrmStyle,WenQuanYi Micro Hei,20,{COLOR_PINK},&H000000FF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,1,1,0,2,10,10,20,1
+Style: Default,WenQuanYi Micro Hei,{ASS_FONT_SIZE},{COLOR_WHITE},&H000000FF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,1,1,0,2,{ASS_MARGIN_H},{ASS_MARGIN_H},20,1
+Style: LingStyle,WenQuanYi Micro Hei,{ASS_FONT_SIZE},{COLOR_BLUE},&H000000FF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,1,1,0,2,{ASS_MARGIN_H},{ASS_MARGIN_H},20,1
+Style: OrmStyle,WenQuanYi Micro Hei,{ASS_FONT_SIZE},{COLOR_PINK},&H000000FF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,1,1,0,2,{ASS_MARGIN_H},{ASS_MARGIN_H},20,1
 
 [Events]
 Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
 """
     
-    ass_body = ""
-    
-    # 解析 SRT
-    # 简单的 SRT 解析器
-    blocks = re.split(r'\n\s*\n', srt_content.strip())
-    
-    for block in blocks:
-        lines = block.split('\n')
-        if len(lines) >= 3:
-            # line[0] 是序号
-            # line[1] 是时间轴
-            times = lines[1].split(' --> ')
-            if len(times) != 2: continue
-            
-            start_time = time_srt_to_ass(times[0].strip())
-            end_time = time_srt_to_ass(times[1].strip())
-            
-            # line[2:] 是文本
-            text = " ".join(lines[2:])
-            
-            # 判定角色
-            style = "Default"
-            if role_1_cn in text or "Ling" in text:
-                style = "LingStyle"
-            elif role_2_cn in text or "Orm" in text:
-                style = "OrmStyle"
-            
-            # 组装 Dialogue 行
-            ass_body += f"Dialogue: 0,{start_time},{end_time},{style},,0,0,0,,{text}\n"
+    if metrics is None:
+        metrics = get_font_metrics(font_path, ASS_FONT_SIZE)
+    max_width = play_res_x - 2 * ASS_MARGIN_H
+    cues = layout_cues(parse_srt_cues(srt_content), [role_1_cn, role_2_cn], metrics, max_width)
+
+    # 按字幕开头的 "名字:" 前缀判定角色 (台词里提到对方名字不算)
+    ling_names = tuple(name for name in (role_1_cn, "Ling") if name)
+    orm_names = tuple(name for name in (role_2_cn, "Orm") if name)
 
+    dialogue_lines = []
+    for start, end, lines, speaker in cues:
+        text = "\\N".join(lines)
+        
+        # 判定角色 (排版后每条字幕只有一个说话人)
+        style = "Default"
+        if speaker and speaker.startswith(ling_names):
+            style = "LingStyle"
+        elif speaker and speaker.startswith(orm_names):
+            style = "OrmStyle"
+        
+        # 组装 Dialogue 行
+        dialogue_lines.append(f"Dialogue: 0,{seconds_to_ass_time(start)},{seconds_to_ass_time(end)},{style},,0,0,0,,{text}\n")
+
+    ass_body = "".join(dialogue_lines)
     return ass_header + ass_body
 
 # --- 4. 辅助函数：字体下载与FFmpeg ---
@@ -152,58 +440,345 @@ def download_font_if_needed():
             pass
     return os.path.abspath(font_path)
 
-def burn_ass_ffmpeg(video_path, ass_path, output_path, mode="soft"):
+FFMPEG_STDERR_TAIL = 40      # 出错时只保留最后 40 行 stderr
+AUDIO_EXTRACT_TIMEOUT = 30 * 60   # 提取音频最多 30 分钟
+BURN_TIMEOUT = 3 * 60 * 60        # 视频合成最多 3 小时，超时杀掉进程，避免会话被永久卡死
+
+async def _kill_process_group(proc):
+    """杀掉 ffmpeg/ffprobe 及其子进程 (整个进程组)"""
+    if proc.returncode is not None:
+        return
+    try:
+        if os.name == "posix":
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+    await proc.wait()
+
+async def run_ffprobe(args, timeout=30):
+    """运行 ffprobe，返回 stdout 文本；超时/失败返回 None，超时或被取消时杀掉进程"""
+    proc = await asyncio.create_subprocess_exec(
+        "ffprobe", "-v", "error", *args,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+        start_new_session=(os.name == "posix")
+    )
+    try:
+        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        return None
+    finally:
+        await _kill_process_group(proc)
+    if proc.returncode != 0:
+        return None
+    return stdout.decode("utf-8", errors="replace")
+
+async def probe_duration(media_path):
+    """用 ffprobe 读取媒体总时长 (秒)，失败返回 None (进度条退化为不确定模式)"""
+    try:
+        output = await run_ffprobe(["-show_entries", "format=duration",
+                                    "-of", "default=noprint_wrappers=1:nokey=1", media_path])
+        return float(output.strip()) or None
+    except (AttributeError, ValueError, OSError):
+        return None
+
+async def probe_video_size(media_path):
+    """用 ffprobe 读取画面显示尺寸 (width, height)，考虑旋转元数据；纯音频/失败返回 None"""
+    output = await run_ffprobe(["-select_streams", "v:0",
+                                "-show_entries", "stream=width,height:stream_tags=rotate:stream_side_data=rotation",
+                                "-of", "json", media_path])
+    try:
+        stream = json.loads(output)["streams"][0]
+        width, height = int(stream["width"]), int(stream["height"])
+    except (TypeError, ValueError, KeyError, IndexError):
+        return None
+    if width <= 0 or height <= 0:
+        return None
+    # 手机竖拍视频常以横向编码 + 旋转 90° 保存
+    rotation = stream.get("tags", {}).get("rotate")
+    for side_data in stream.get("side_data_list", []):
+        rotation = side_data.get("rotation", rotation)
+    try:
+        if abs(int(float(rotation or 0))) % 180 == 90:
+            width, height = height, width
+    except ValueError:
+        pass
+    return width, height
+
+def _parse_progress_block(block, duration):
+    """
+    解析一段 -progress 输出 (key=value，以 progress=continue/end 结尾)
+    返回 {"percent", "out_time", "fps", "speed", "eta", "done"}
+    """
+    out_time = None
+    # out_time_ms 名字有误导性，实际单位也是微秒
+    for key in ("out_time_us", "out_time_ms"):
+        try:
+            out_time = int(block[key]) / 1_000_000
+            break
+        except (KeyError, ValueError):
+            continue
+
+    try:
+        fps = float(block.get("fps", ""))
+    except ValueError:
+        fps = None
+
+    try:
+        speed = float(block.get("speed", "").rstrip("x"))
+    except ValueError:
+        speed = None
+
+    done = block.get("progress") == "end"
+    percent = None
+    eta = None
+    if duration and out_time is not None:
+        percent = 1.0 if done else max(0.0, min(out_time / duration, 1.0))
+        if speed:
+            eta = max(duration - out_time, 0.0) / speed
+
+    return {"percent": percent, "out_time": out_time, "fps": fps, "speed": speed, "eta": eta, "done": done}
+
+async def run_ffmpeg(args, duration=None, on_progress=None, timeout=None):
+    """
+    运行 ffmpeg 并通过 -progress pipe:1 增量读取进度 (协程，不占线程)
+    - on_progress(info): 每个进度块回调一次，在事件循环线程中执行
+    - timeout: 总超时 (秒)，超时后杀掉进程组
+    - 任务被取消 (task.cancel) 时同样杀掉进程组
+    stderr 只保留最后 FFMPEG_STDERR_TAIL 行，不再整段读进内存
+    """
+    cmd = ["ffmpeg", "-hide_banner", "-nostats", "-nostdin", "-progress", "pipe:1"] + list(args)
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        # 独立进程组：取消/超时时可以连同子进程一起杀掉
+        start_new_session=(os.name == "posix"),
+        limit=1 << 20
+    )
+
+    stderr_tail = collections.deque(maxlen=FFMPEG_STDERR_TAIL)
+
+    async def drain_stderr():
+        async for raw in proc.stderr:
+            stderr_tail.append(raw.decode("utf-8", errors="replace").rstrip())
+
+    async def read_progress():
+        block = {}
+        async for raw in proc.stdout:
+            key, sep, value = raw.decode("utf-8", errors="replace").strip().partition("=")
+            if not sep:
+                continue
+            block[key] = value
+            if key == "progress":
+                if on_progress:
+                    on_progress(_parse_progress_block(block, duration))
+                block = {}
+        return await proc.wait()
+
+    stderr_task = asyncio.ensure_future(drain_stderr())
+    try:
+        returncode = await asyncio.wait_for(read_progress(), timeout)
+        await stderr_task
+    except asyncio.TimeoutError:
+        raise Exception(f"FFmpeg Timeout: exceeded {timeout}s")
+    finally:
+        # 超时或任务被取消时，保证 ffmpeg 不留孤儿进程
+        await _kill_process_group(proc)
+        stderr_task.cancel()
+
+    if returncode != 0:
+        raise Exception("FFmpeg Error: " + "\n".join(stderr_tail))
+
+def format_ffmpeg_progress(label, info):
+    """把进度信息格式化成进度条上的文字"""
+    parts = [label]
+    if info["percent"] is not None:
+        parts.append(f"{info['percent'] * 100:.0f}%")
+    if info["fps"]:
+        parts.append(f"{info['fps']:.0f} fps")
+    if info["speed"]:
+        parts.append(f"{info['speed']:.2f}x")
+    if info["eta"] is not None:
+        parts.append(f"ETA {int(info['eta'] // 60)}:{int(info['eta'] % 60):02d}")
+    if info.get("note"):
+        parts.append(info["note"])
+    return " · ".join(parts)
+
+# 软字幕封装格式：扩展名 -> 该输出专属的 ffmpeg 参数 (放在 -map 之后、输出路径之前)
+SOFT_SUB_FORMATS = {
+    # MKV：原样保留 ASS 样式 (颜色/字体)
+    "mkv": ["-c:v", "copy", "-c:a", "copy", "-c:s", "ass"],
+    # MP4：标准容器只认 mov_text，颜色会丢失，但剪映/手机/网页都能识别
+    "mp4": ["-c:v", "copy", "-c:a", "copy", "-c:s", "mov_text", "-movflags", "+faststart"],
+    # WebVTT：纯字幕外挂文件，给网页播放器用
+    "vtt": ["-c:s", "webvtt"],
+}
+
+# MP4 能直接 stream copy 的编码；WAV 的 PCM、MKV 里的 Vorbis 等放不进 MP4
+MP4_COPY_CODECS = {
+    "video": {"h264", "hevc", "mpeg4", "av1", "vp9", "mjpeg", "png"},
+    "audio": {"aac", "mp3", "ac3", "eac3", "alac", "opus", "flac"},
+}
+
+async def probe_stream_codecs(media_path):
+    """用 ffprobe 读取各条流的编码 -> [(codec_type, codec_name)]，失败返回 None"""
+    output = await run_ffprobe(["-show_entries", "stream=codec_type,codec_name", "-of", "json", media_path])
+    try:
+        streams = json.loads(output)["streams"]
+    except (TypeError, ValueError, KeyError):
+        return None
+    return [(s.get("codec_type"), s.get("codec_name")) for s in streams]
+
+def mp4_can_copy(codecs):
+    """原片的音视频流是否都能直接放进 MP4 (探测失败时按可以处理，交给 ffmpeg 报错回退)"""
+    if codecs is None:
+        return True
+    return all(name in MP4_COPY_CODECS[kind] for kind, name in codecs if kind in MP4_COPY_CODECS)
+
+def _soft_sub_args(fmt, out_path):
+    """单个软字幕输出的 -map/编码参数 + 输出路径"""
+    if fmt not in SOFT_SUB_FORMATS:
+        raise Exception(f"Unsupported soft-sub format: {fmt}")
+    args = []
+    if fmt != "vtt":
+        # 只取原片的音视频；原片自带的字幕流编码未必能放进目标容器
+        args += ["-map", "0:v?", "-map", "0:a?"]
+    args += ["-map", "1:0"] + SOFT_SUB_FORMATS[fmt]
+    if fmt != "vtt":
+        args += ["-metadata:s:s:0", "language=chi", "-disposition:s:0", "default"]
+    return args + [os.path.abspath(out_path)]
+
+MP4_CODEC_SKIP_REASON = "the source audio/video codecs can't be copied into MP4. Use MKV or Hard Burn instead."
+
+# ffmpeg 报错里标明是第几个输出：新版 "[out#1/mp4 @ ...]"，旧版 "output file #1" / "output stream 1:0"
+_OUTPUT_ERROR_RE = re.compile(r'\bout#(\d+)/|output file #(\d+)|output stream (\d+):', re.I)
+_ERROR_LINE_RE = re.compile(r'error|could not|not supported|invalid|failed', re.I)
+_INPUT_ERROR_RE = re.compile(r'\bin#\d|input', re.I)
+
+def _failed_outputs(error_text, count):
     """
-    mode="soft": 封装 ASS 流 (推荐，播放器可开关，有颜色，可提取编辑)
+    从 ffmpeg 的错误输出里找出是哪几个输出出的错 -> {输出序号: 错误行}
+    错误和输入有关 (文件损坏/读不了)，或者认不出是哪个输出时返回空 dict：这种情况重跑也没用
+    """
+    failed = {}
+    for line in error_text.splitlines():
+        if not _ERROR_LINE_RE.search(line):
+            continue
+        if _INPUT_ERROR_RE.search(line):
+            return {}
+        for match in _OUTPUT_ERROR_RE.finditer(line):
+            index = int(next(group for group in match.groups() if group is not None))
+            if index < count:
+                failed.setdefault(index, line.strip())
+    return failed
+
+async def mux_soft_subs(video_path, ass_path, outputs, on_progress=None, timeout=None):
+    """
+    一次 ffmpeg 调用同时写出多个软字幕成品 (输入只读一遍，音视频全部 stream copy)
+    outputs: {"mkv": path, "mp4": path, "vtt": path}，按需传其中几项
+    返回 (实际写出的 {fmt: path}, 没写出的 {fmt: 原因})：
+    - 原片编码放不进 MP4 时事先跳过 mp4
+    - 合并运行时某个输出单独报错，去掉它，其余格式再合并跑一次；输入出错、超时不重试
+    timeout 是整次调用 (含重试) 的总时限
+    """
+    video_abs_path = os.path.abspath(video_path)
+    ass_abs_path = os.path.abspath(ass_path).replace("\\", "/")
+
+    outputs = dict(outputs)
+    errors = {}
+    if "mp4" in outputs and not mp4_can_copy(await probe_stream_codecs(video_abs_path)):
+        outputs.pop("mp4")
+        errors["mp4"] = MP4_CODEC_SKIP_REASON
+    if not outputs:
+        return {}, errors
+
+    inputs = ["-y", "-i", video_abs_path, "-i", ass_abs_path]
+    duration = await probe_duration(video_abs_path)
+    try:
+        async with asyncio.timeout(timeout):
+            for attempt in range(len(outputs)):
+                cmd = list(inputs)
+                for fmt, out_path in outputs.items():
+                    cmd += _soft_sub_args(fmt, out_path)
+                progress = on_progress
+                if attempt and on_progress:
+                    # 重试时进度条从 0 重新开始，标明是第几次重试、在写哪些格式
+                    note = f"retry {attempt}: " + "+".join(fmt.upper() for fmt in outputs)
+                    progress = lambda info, note=note: on_progress({**info, "note": note})
+                try:
+                    await run_ffmpeg(cmd, duration=duration, on_progress=progress)
+                    return outputs, errors
+                except Exception as e:
+                    failed = _failed_outputs(str(e), len(outputs))
+                    if not failed or len(failed) == len(outputs):
+                        raise
+                    formats = list(outputs)
+                    for index, line in failed.items():
+                        errors[formats[index]] = line
+                        outputs.pop(formats[index])
+    except TimeoutError:
+        raise Exception(f"FFmpeg Timeout: exceeded {timeout}s")
+
+async def burn_ass_ffmpeg(video_path, ass_path, output_path, mode="soft", on_progress=None, timeout=None):
+    """
+    mode="soft": 封装 ASS 流 (推荐，播放器可开关，有颜色，可提取编辑；.mp4 输出为 mov_text，无颜色)
     mode="hard": 硬烧录 (文字焊死在视频上，有颜色)
+    on_progress / timeout 直接传给 run_ffmpeg
     """
     video_abs_path = os.path.abspath(video_path)
     ass_abs_path = os.path.abspath(ass_path).replace("\\", "/")
     
     if mode == "soft":
-        # 封装模式：MP4 容器可以容纳 ASS 流，但兼容性最好的其实是 MKV
-        # 为了剪映/手机兼容性，我们尝试封装进 MP4，如果不被识别，用户可以使用硬烧录
-        cmd = [
-            "ffmpeg", "-i", video_abs_path, "-i", ass_abs_path,
-            "-c", "copy", "-c:s", "mov_text", # MP4 标准容器不支持 ASS 样式流，只能转 mov_text (会丢失颜色)
-            # 这是一个技术两难：MP4软字幕很难带颜色。
-            # 为了“可编辑且带颜色”，我们推荐用户下载 .ASS 文件，
-            # 或者我们生成 MKV (支持彩色软字幕)，但用户可能要 MP4。
-            # 
-            # 策略调整：
-            # Soft 模式：生成 MKV (完美支持彩色软字幕)
-            # Hard 模式：生成 MP4 (烧录颜色)
-            "-map", "0", "-map", "1",
-            "-c:v", "copy", "-c:a", "copy", "-c:s", "ass", 
-            "-y", output_path.replace(".mp4", ".mkv") # 强制改后缀为 mkv 以支持样式
-        ]
-        final_output = output_path.replace(".mp4", ".mkv")
+        # 封装模式：按输出后缀选容器，.mp4 走 mov_text 快速通道 (不再强制改成 .mkv)
+        fmt = Path(output_path).suffix.lstrip(".").lower()
+        if fmt not in SOFT_SUB_FORMATS:
+            fmt = "mkv"
+            output_path = str(Path(output_path).with_suffix(".mkv"))
+        outputs, _ = await mux_soft_subs(video_path, ass_path, {fmt: output_path}, on_progress=on_progress, timeout=timeout)
+        if fmt not in outputs:
+            # 原片编码放不进 MP4：退回 MKV
+            output_path = str(Path(output_path).with_suffix(".mkv"))
+            outputs, _ = await mux_soft_subs(video_path, ass_path, {"mkv": output_path}, on_progress=on_progress, timeout=timeout)
+            return outputs["mkv"]
+        return outputs[fmt]
         
     else:
         # 硬烧录模式
-        font_file = download_font_if_needed()
+        font_file = await asyncio.to_thread(download_font_if_needed)
         # 必须指定 fontsdir 否则 Linux 可能找不到字体
         vf_cmd = f"subtitles='{ass_abs_path}':fontsdir='.'"
         
         cmd = [
-            "ffmpeg", "-i", video_abs_path, 
+            "-i", video_abs_path, 
             "-vf", vf_cmd,
             "-c:a", "copy", 
             "-c:v", "libx264", "-preset", "ultrafast", "-crf", "23",
             "-y", output_path
         ]
-        final_output = output_path
     
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if result.returncode != 0:
-        raise Exception(f"FFmpeg Error: {result.stderr.decode('utf-8')}")
+    await run_ffmpeg(cmd, duration=await probe_duration(video_abs_path), on_progress=on_progress, timeout=timeout)
     
-    return final_output
+    return output_path
 
 # --- 5. 核心逻辑：智能模型 ---
 
+def configure_genai(api_key):
+    """
+    GEMINI_API_ENDPOINT 可把请求指向本地的假模型服务 (压测用，见 tools/fake_gemini_server.py)
+    FAKE_GEMINI_DISCOVERY_URL 把文件上传也指过去：SDK 上传前固定从 discovery 地址取接口，不受 api_endpoint 影响
+    """
+    discovery_url = os.environ.get("FAKE_GEMINI_DISCOVERY_URL")
+    if discovery_url:
+        import google.generativeai.client as genai_client
+        genai_client.GENAI_API_DISCOVERY_URL = discovery_url
+    endpoint = os.environ.get("GEMINI_API_ENDPOINT")
+    if endpoint:
+        genai.configure(api_key=api_key, client_options={"api_endpoint": endpoint})
+    else:
+        genai.configure(api_key=api_key)
+
 def get_valid_flash_model(api_key):
-    genai.configure(api_key=api_key)
+    configure_genai(api_key)
     try:
         available_models = [m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
         flash_models = [m for m in available_models if "flash" in m]
@@ -213,411 +788,506 @@ def get_valid_flash_model(api_key):
     except:
         return "gemini-1.5-flash"
 
-def generate_safe(file_obj, prompt, model_name):
+async def generate_safe(file_obj, prompt, model_name):
     for attempt in range(3):
         try:
             model = genai.GenerativeModel(model_name)
-            response = model.generate_content([file_obj, prompt], request_options={"timeout": 600})
+            response = await model.generate_content_async([file_obj, prompt], request_options={"timeout": 600})
             return response.text
         except Exception as e:
             if "429" in str(e).lower():
-                time.sleep(10 * (attempt + 1))
+                await asyncio.sleep(10 * (attempt + 1))
                 continue
             raise e
     raise Exception("API Busy")
 
-# --- 6. 获取 API Key ---
-try:
-    API_KEY = st.secrets["GOOGLE_API_KEY"]
-except:
-    API_KEY = None
+async def transcribe_audio(audio_path, prompt, model_name):
+    """上传音频 -> 等待处理 -> 生成字幕 -> 清理云端，返回 SRT 文本"""
+    # SDK 的文件接口只有同步版本，放到线程池里跑，轮询间隔用 asyncio.sleep
+    audio_file = await asyncio.to_thread(genai.upload_file, path=audio_path)
+    try:
+        while audio_file.state.name == "PROCESSING":
+            await asyncio.sleep(2)
+            audio_file = await asyncio.to_thread(genai.get_file, audio_file.name)
+        return await generate_safe(audio_file, prompt, model_name)
+    finally:
+        try: await asyncio.to_thread(audio_file.delete)
+        except: pass
 
-# --- 7. 界面构建 ---
-st.markdown("""
-<div class="hero-container">
-    <div class="hero-title">LingOrm AI Studio</div>
-    <div class="hero-quote">“Can you stay forever?”</div>
-</div>
-""", unsafe_allow_html=True)
+# --- 6. 音频指纹去重：同一集换了封装/分辨率/片头也能复用之前的字幕 ---
 
-with st.container():
-    st.markdown('<div class="clean-card">', unsafe_allow_html=True)
-    st.markdown("##### 1. Upload Video / Audio")
-    uploaded_file = st.file_uploader("", type=["mp4", "mov", "mkv", "mp3", "wav"], label_visibility="collapsed")
-    
-    st.markdown("---")
-    
-    with st.expander("⚙️ Advanced Settings (Role Names & Filters)", expanded=False):
-        col1, col2 = st.columns(2)
-        with col1:
-            role_1 = st.text_input("Role A (Blue)", value="LingLing")
-            role_1_cn = st.text_input("Role A (Keyword)", value="Ling姐")
-        with col2:
-            role_2 = st.text_input("Role B (Pink)", value="Orm")
-            role_2_cn = st.text_input("Role B (Keyword)", value="Orm")
-        blacklist_str = st.text_input("Blacklist", value="迪哥,妈妈达,迪桑达,条纹,时髦,鲁尼特,字幕组")
-        blacklist = [x.strip() for x in blacklist_str.split(",") if x.strip()]
+FP_DB_PATH = "fingerprints.sqlite3"
+FP_SAMPLE_RATE = 16000   # 与提取出的音频一致
+FP_FRAME = 4096          # 每帧 256ms
+FP_HOP = 512             # 帧移 32ms，也是对齐精度
+FP_BANDS = 33            # 300-2000Hz 分 33 个对数频带 -> 每帧 32 bit
+FP_BLOCK = 256           # 按 ~8 秒一块校验匹配
+FP_EDGE_WINDOW = 32      # 匹配片段边缘按 ~1 秒窗口精修
+FP_MAX_BER = 0.35        # 一块内误码率低于此值视为同一段音频
+FP_MIN_VOTES = 20        # 同一偏移至少命中这么多帧才进入校验
+FP_MAX_CANDIDATES = 10   # 最多校验的 (任务, 偏移) 候选数
+FP_MIN_GAP_SECONDS = 1.0 # 更短的未匹配片段不再单独送去模型
+FP_SILENCE_HASHES = (0, 0xFFFFFFFF)
+FP_MAX_AGE = 90 * 24 * 3600  # 指纹库只保留 90 天内的任务
+FP_MAX_JOBS = 200        # 最多保留最近 200 个任务 (每小时音频约 2MB 指纹 + 索引)
 
-    st.write("")
-    if uploaded_file:
-        generate_btn = st.button("✨ Generate Magic (开始生成)")
-    else:
-        st.info("👆 Please upload a file to start.")
-        generate_btn = False
+FP_BATCH = 256           # 每批 FFT 的帧数 (~1MB 样本 + ~8MB 频谱)
 
-    st.markdown('</div>', unsafe_allow_html=True)
+def compute_fingerprint(pcm_path):
+    """
+    对 16kHz 单声道 s16le PCM 计算能量差分指纹 (每帧一个 32 bit hash)
+    bit = 相邻频带能量差在相邻帧之间是否增大，对重编码/音量变化不敏感
+    PCM 用 memmap 按批读取、按批转 float32，整集音频不会一次性进内存
+    """
+    if os.path.getsize(pcm_path) < 2 * FP_FRAME:
+        return np.zeros(0, dtype=np.uint32)
+    samples = np.memmap(pcm_path, dtype="<i2", mode="r")
+    # 滑动窗口视图：不复制数据，每一行是一帧
+    frames_view = np.lib.stride_tricks.sliding_window_view(samples, FP_FRAME)[::FP_HOP]
+    n_frames = len(frames_view)
 
-# --- 8. 执行逻辑 ---
-if generate_btn and uploaded_file:
-    if not API_KEY:
-        st.error("🔒 Error: No API Key found in Secrets.")
-    else:
-        status_msg = st.empty()
-        progress_bar = st.progress(0)
-        
-        tmp_video_path = None
-        audio_path = None
-        srt_path = None
-        ass_path = None
-        final_video_path = None
-        
-        try:
-            # 1. 准备文件
-            status_msg.markdown("**📂 Preparing Workspace...**")
-            with tempfile.NamedTemporaryFile(delete=False, suffix=Path(uploaded_file.name).suffix) as tmp_file:
-                tmp_file.write(uploaded_file.read())
-                tmp_video_path = tmp_file.name
-            
-            # 2. 提取音频
-            status_msg.markdown("**🎧 Extracting Audio Stream...**")
-            progress_bar.progress(10)
-            audio_path = tmp_video_path + ".mp3"
-            subprocess.run(["ffmpeg", "-i", tmp_video_path, "-vn", "-ac", "1", "-ar", "16000", "-b:a", "32k", "-y", audio_path], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-            # 3. AI 生成字幕
-            status_msg.markdown("**☁️ AI Listening & Translating...**")
-            progress_bar.progress(30)
-            
-            genai.configure(api_key=API_KEY)
-            video_file = genai.upload_file(path=audio_path)
-            while video_file.state.name == "PROCESSING":
-                time.sleep(2)
-                video_file = genai.get_file(video_file.name)
-            
-            # Prompt 强调格式
-            prompt = f"""
-            Task: Transcribe and translate to Simplified Chinese Subtitles (SRT).
-            Context: Conversation between {role_1} and {role_2}.
-            Rules:
-            1. **IMPORTANT**: Start every dialogue line with "{role_1_cn}:" or "{role_2_cn}:".
-            2. "Phi Ling" -> "{role_1_cn}", "Nong Orm" -> "{role_2_cn}".
-            3. Tone: Sweet, romantic.
-            4. No words: {', '.join(blacklist)}.
-            5. Output ONLY valid SRT format.
-            """
-            
-            valid_model = get_valid_flash_model(API_KEY)
-            subtitle_text = generate_safe(video_file, prompt, valid_model)
-            
-            # 保存 SRT
-            srt_path = tmp_video_path + ".srt"
-            with open(srt_path, "w", encoding="utf-8") as f:
-                f.write(subtitle_text)
-            
-            # --- 新增步骤：SRT 转 彩色 ASS ---
-            status_msg.markdown("**🎨 Painting Subtitle Colors (Blue & Pink)...**")
-            ass_content = convert_srt_to_ass_colored(subtitle_text, role_1_cn, role_2_cn)
-            ass_path = tmp_video_path + ".ass"
-            with open(ass_path, "w", encoding="utf-8") as f:
-                f.write(ass_content)
-
-            # 清理云端
-            try: video_file.delete()
-            except: pass
-            
-            # 4. 视频合成 UI
-            progress_bar.progress(80)
-            status_msg.success("✅ Subtitles Generated! Choose Output Format below.")
-            
-            st.markdown('<div class="clean-card">', unsafe_allow_html=True)
-            st.markdown("##### 🎬 Final Video Studio (Colored)")
-            
-            tab1, tab2 = st.tabs(["🌈 Colored Soft Subs (Editable)", "🔥 Hard Burn (Permanent)"])
-            
-            with tab1:
-                st.info("💡 **Recommended for Players**: Downloads an MKV video with embedded styled subtitles. You can turn them on/off, and colors will show in players like PotPlayer/VLC.")
-                st.text_area("ASS Content (Style Source)", ass_content, height=100)
-                
-                col_s1, col_s2 = st.columns(2)
-                with col_s1:
-                    st.download_button("📥 Download .ASS File", ass_content, f"{Path(uploaded_file.name).stem}.ass", "text/plain")
-                with col_s2:
-                    if st.button("🚀 Generate MKV (Soft Subs)"):
-                        try:
-                            with st.spinner("Embedding ASS stream..."):
-                                target_file = tmp_video_path + "_soft.mkv"
-                                real_output = burn_ass_ffmpeg(tmp_video_path, ass_path, target_file, mode="soft")
-                                with open(real_output, "rb") as v_file:
-                                    st.download_button("📥 Download Video (MKV)", v_file, f"{Path(uploaded_file.name).stem}_soft.mkv", "video/x-matroska")
-                        except Exception as e:
-                            st.error(f"Error: {e}")
-            
-            with tab2:
-                st.info("⚠️ **For Social Media**: Burns the colors permanently into the video. Text cannot be edited afterwards, but colors are guaranteed everywhere.")
-                if st.button("🔥 Hard Burn (MP4)"):
-                    try:
-                        with st.spinner("Rendering video (Slow)..."):
-                            target_file = tmp_video_path + "_hard.mp4"
-                            real_output = burn_ass_ffmpeg(tmp_video_path, ass_path, target_file, mode="hard")
-                            st.success("Render Complete!")
-                            with open(real_output, "rb") as v_file:
-                                st.download_button("📥 Download Video (MP4)", v_file, f"{Path(uploaded_file.name).stem}_burned.mp4", "video/mp4")
-                    except Exception as e:
-                        st.error(f"Render Failed: {e}")
-
-            st.markdown('</div>', unsafe_allow_html=True)
-            progress_bar.progress(100)
+    window = np.hanning(FP_FRAME).astype(np.float32)
+    freqs = np.fft.rfftfreq(FP_FRAME, 1 / FP_SAMPLE_RATE)
+    band_of_bin = np.digitize(freqs, np.geomspace(300, 2000, FP_BANDS + 1)) - 1
+    band_matrix = np.zeros((len(freqs), FP_BANDS), dtype=np.float32)
+    in_range = (band_of_bin >= 0) & (band_of_bin < FP_BANDS)
+    band_matrix[np.nonzero(in_range)[0], band_of_bin[in_range]] = 1.0
 
-        except Exception as e:
-            st.error(f"❌ Error: {str(e)}")
-        
-        finally:
-            if tmp_video_path and os.path.exists(tmp_video_path): os.remove(tmp_video_path)
-            if audio_path and os.path.exists(audio_path): os.remove(audio_path)import streamlit as st
-import google.generativeai as genai
-import tempfile
-import os
-import subprocess
-import time
-import re
-import requests
-from pathlib import Path
+    energies = np.empty((n_frames, FP_BANDS), dtype=np.float32)
+    for start in range(0, n_frames, FP_BATCH):
+        frames = frames_view[start:start + FP_BATCH].astype(np.float32) * window
+        spectrum = np.fft.rfft(frames, axis=1)
+        power = (spectrum.real ** 2 + spectrum.imag ** 2).astype(np.float32, copy=False)
+        energies[start:start + FP_BATCH] = power @ band_matrix
+    del frames_view, samples
 
-# --- 1. 页面配置 ---
-st.set_page_config(
-    page_title="LingOrm · The Secret Voice",
-    page_icon="🦋",
-    layout="centered",
-    initial_sidebar_state="collapsed"
-)
+    band_diff = energies[:, :-1] - energies[:, 1:]
+    bits = (band_diff[1:] - band_diff[:-1]) > 0
+    # 第 j 个频带差 -> hash 的第 j 位 (低位在前)
+    return np.packbits(bits, axis=1, bitorder="little").view("<u4").ravel().astype(np.uint32)
 
-# --- 2. CSS: 诺丁山·极简高端风格 ---
-st.markdown("""
-<style>
-    @import url('https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600&family=Playfair+Display:ital,wght@1,400&display=swap');
-    
-    .stApp { background-color: #F8F9FA; font-family: 'Inter', sans-serif; color: #1F2937; }
-    #MainMenu {visibility: hidden;} footer {visibility: hidden;} header {visibility: hidden;}
+def _bit_error_rate(a, b):
+    return np.unpackbits(np.bitwise_xor(a, b).view(np.uint8)).sum() / (32 * len(a))
 
-    .hero-container { text-align: center; padding: 60px 0 30px 0; }
-    .hero-title {
-        font-size: 2.8rem; font-weight: 700;
-        background: -webkit-linear-gradient(45deg, #7C3AED, #C084FC);
-        -webkit-background-clip: text; -webkit-text-fill-color: transparent;
-        margin-bottom: 8px; letter-spacing: -0.03em;
-    }
-    .hero-quote { font-family: 'Playfair Display', serif; font-style: italic; font-size: 1.3rem; color: #6B7280; margin-top: 10px; }
+def _open_fingerprint_db(db_path=FP_DB_PATH):
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute("""CREATE TABLE IF NOT EXISTS fp_jobs (
+        job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        settings_key TEXT NOT NULL, created REAL NOT NULL,
+        hashes BLOB NOT NULL, srt TEXT NOT NULL)""")
+    conn.execute("CREATE TABLE IF NOT EXISTS fp_index (hash INTEGER NOT NULL, job_id INTEGER NOT NULL, frame INTEGER NOT NULL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS fp_index_hash ON fp_index (hash)")
+    conn.execute("CREATE INDEX IF NOT EXISTS fp_index_job ON fp_index (job_id)")
+    return conn
 
-    .clean-card {
-        background: white; padding: 40px; border-radius: 24px;
-        box-shadow: 0 10px 25px -5px rgba(0, 0, 0, 0.05), 0 8px 10px -6px rgba(0, 0, 0, 0.01);
-        border: 1px solid #F3F4F6; margin-bottom: 24px;
-    }
+def fingerprint_settings_key(prompt, model_name):
+    """只复用同样 prompt (角色名/黑名单) 和模型生成的字幕"""
+    return hashlib.sha1(f"{model_name}\n{prompt}".encode("utf-8")).hexdigest()
 
-    .stButton>button {
-        background: linear-gradient(135deg, #7C3AED 0%, #6D28D9 100%);
-        color: white; border-radius: 12px; border: none; height: 55px;
-        font-size: 16px; font-weight: 600; box-shadow: 0 4px 14px 0 rgba(124, 58, 237, 0.3);
-        transition: all 0.2s ease-in-out; width: 100%;
-    }
-    .stButton>button:hover { transform: translateY(-2px); box-shadow: 0 6px 20px rgba(124, 58, 237, 0.4); }
+def find_fingerprint_matches(hashes, settings_key, db_path=FP_DB_PATH):
+    """
+    在历史任务中查找与 hashes 匹配的片段
+    返回 [(start_frame, end_frame, job_id, offset_frames)]，历史帧号 = 本次帧号 + offset
+    """
+    query_positions = collections.defaultdict(list)
+    for frame, h in enumerate(hashes.tolist()):
+        if h not in FP_SILENCE_HASHES:
+            query_positions[h].append(frame)
+    # 反复出现的 hash (静音/音乐循环) 没有定位价值
+    distinct = [h for h, frames in query_positions.items() if len(frames) <= 50]
+    if not distinct:
+        return []
 
-    [data-testid='stFileUploader'] { border: 2px dashed #E5E7EB; border-radius: 16px; padding: 30px; background-color: #F9FAFB; transition: border-color 0.3s; }
-    [data-testid='stFileUploader']:hover { border-color: #7C3AED; }
+    conn = _open_fingerprint_db(db_path)
+    try:
+        # 1. 投票：每个命中的 hash 为 (任务, 时间偏移) 投一票
+        votes = collections.Counter()
+        for i in range(0, len(distinct), 500):
+            chunk = distinct[i:i + 500]
+            rows = conn.execute(
+                f"""SELECT i.hash, i.job_id, i.frame FROM fp_index i JOIN fp_jobs j ON j.job_id = i.job_id
+                    WHERE j.settings_key = ? AND i.hash IN ({",".join("?" * len(chunk))})""",
+                [settings_key] + chunk
+            )
+            for h, job_id, frame in rows:
+                for query_frame in query_positions[h]:
+                    votes[(job_id, frame - query_frame)] += 1
 
-    .stTextInput>div>div>input { background-color: #ffffff; border: 1px solid #E5E7EB; color: #374151; border-radius: 10px; padding: 10px; }
-    .stProgress > div > div > div > div { background-color: #7C3AED; }
-    .stTextArea textarea { background-color: #F9FAFB; border: 1px solid #E5E7EB; border-radius: 12px; font-family: monospace; }
-</style>
-""", unsafe_allow_html=True)
+        # 2. 校验：按块比较误码率，得票高的候选先认领
+        n_blocks = -(-len(hashes) // FP_BLOCK)
+        block_owner = [None] * n_blocks
+        job_hashes = {}
+        for (job_id, offset), count in votes.most_common(FP_MAX_CANDIDATES):
+            if count < FP_MIN_VOTES:
+                break
+            if job_id not in job_hashes:
+                blob = conn.execute("SELECT hashes FROM fp_jobs WHERE job_id = ?", (job_id,)).fetchone()[0]
+                job_hashes[job_id] = np.frombuffer(blob, dtype="<u4")
+            stored = job_hashes[job_id]
+            for b in range(n_blocks):
+                start, end = b * FP_BLOCK, min((b + 1) * FP_BLOCK, len(hashes))
+                if block_owner[b] is not None or end - start < FP_BLOCK // 4:
+                    continue
+                if start + offset < 0 or end + offset > len(stored):
+                    continue
+                if _bit_error_rate(hashes[start:end], stored[start + offset:end + offset]) < FP_MAX_BER:
+                    block_owner[b] = (job_id, offset)
+    finally:
+        conn.close()
 
-# --- 3. 核心功能：SRT 转 ASS (带颜色) ---
+    # 3. 合并相邻、同来源的块
+    spans = []
+    for b, owner in enumerate(block_owner):
+        if owner is None:
+            continue
+        start, end = b * FP_BLOCK, min((b + 1) * FP_BLOCK, len(hashes))
+        if spans and spans[-1][1] == start and spans[-1][2:] == owner:
+            spans[-1] = (spans[-1][0], end) + owner
+        else:
+            spans.append((start, end) + owner)
 
-def time_srt_to_ass(srt_time):
-    """将 SRT 时间格式 (00:00:00,000) 转换为 ASS 时间格式 (0:00:00.00)"""
-    try:
-        h, m, s_ms = srt_time.split(':')
-        s, ms = s_ms.split(',')
-        # ASS 只需要两位毫秒
-        return f"{int(h)}:{m}:{s}.{ms[:2]}"
-    except:
-        return "0:00:00.00"
+    # 4. 边缘精修：一块里可能只有一半是旧内容，按小窗口把不匹配的边缘裁掉
+    refined = []
+    for start, end, job_id, offset in spans:
+        stored = job_hashes[job_id]
+        def window_matches(a, b):
+            return _bit_error_rate(hashes[a:b], stored[a + offset:b + offset]) < FP_MAX_BER
+        while end - start >= FP_EDGE_WINDOW and not window_matches(start, start + FP_EDGE_WINDOW):
+            start += FP_EDGE_WINDOW
+        while end - start >= FP_EDGE_WINDOW and not window_matches(end - FP_EDGE_WINDOW, end):
+            end -= FP_EDGE_WINDOW
+        if end - start >= FP_EDGE_WINDOW:
+            refined.append((start, end, job_id, offset))
+    return refined
 
-def convert_srt_to_ass_colored(srt_content, role_1_cn, role_2_cn):
+def plan_fingerprint_reuse(hashes, settings_key, duration, db_path=FP_DB_PATH):
     """
-    将 SRT 字幕转换为带有角色颜色的 ASS 字幕
-    Ling (Role 1) -> Blue
-    Orm (Role 2) -> Pink
-    Others -> White
+    返回 (reused_cues, gaps)
+    - reused_cues: 从历史任务平移过来的 [(start_s, end_s, text)]
+    - gaps: 仍需送去模型的 [(start_s, end_s)]
     """
-    
-    # ASS 颜色代码是 BGR 顺序 (Blue, Green, Red)
-    # 浅蓝色 (SkyBlue): &H00EBCE87 (BGR) -> RGB(135, 206, 235)
-    # 修正蓝色 (Ling): &H00FFBF00 (DeepSkyBlue BGR)
-    COLOR_BLUE = "&H00FFBF00" 
-    
-    # 粉色 (HotPink): RGB(255, 105, 180) -> BGR(180, 105, 255) -> &H00B469FF
-    # 修正粉色 (Orm): &H009999FF (Light Pink)
-    COLOR_PINK = "&H009999FF"
-    
-    COLOR_WHITE = "&H00FFFFFF"
+    frame_seconds = FP_HOP / FP_SAMPLE_RATE
+    spans = find_fingerprint_matches(hashes, settings_key, db_path)
+    if not spans:
+        return [], [(0.0, duration)]
 
-    # 定义 ASS 头部
-    ass_header = f"""[Script Info]
-Title: LingOrm Subtitles
-ScriptType: v4.00+
-WrapStyle: 0
-ScaledBorderAndShadow: yes
-YCbCr Matrix: None
+    conn = _open_fingerprint_db(db_path)
+    try:
+        srt_by_job = {job_id: conn.execute("SELECT srt FROM fp_jobs WHERE job_id = ?", (job_id,)).fetchone()[0]
+                      for job_id in {span[2] for span in spans}}
+    finally:
+        conn.close()
 
-[V4+ Styles]
-Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
-Style: Default,WenQuanYi Micro Hei,20,{COLOR_WHITE},&H000000FF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,1,1,0,2,10,10,20,1
-Style: LingStyle,WenQuanYi Micro Hei,20,{COLOR_BLUE},&H000000FF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,1,1,0,2,10,10,20,1
-Style: OrmStyle,WenQuanYi Micro Hei,20,{COLOR_PINK},&H000000FF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,1,1,0,2,10,10,20,1
+    reused_cues = []
+    covered = []
+    for start, end, job_id, offset in spans:
+        span_start, span_end = start * frame_seconds, end * frame_seconds
+        # 最后一块延伸到音频结尾 (指纹帧覆盖不到最后不足一帧的部分)
+        if end == len(hashes):
+            span_end = duration
+        shift = offset * frame_seconds
+        span_cues = []
+        for cue_start, cue_end, text in parse_srt_cues(srt_by_job[job_id]):
+            local_start, local_end = cue_start - shift, cue_end - shift
+            # 以字幕中点归属，避免边界处的字幕被两段重复使用
+            if span_start <= (local_start + local_end) / 2 < span_end:
+                span_cues.append((max(local_start, 0.0), min(local_end, duration), text))
+        reused_cues += span_cues
+        # 复用的字幕可能越过片段边界：覆盖范围扩到字幕外沿，未匹配片段从那里开始，
+        # 否则边界上那句话会被模型再听写一遍
+        covered.append((min([span_start] + [cue[0] for cue in span_cues]),
+                        max([span_end] + [cue[1] for cue in span_cues])))
+    covered.sort()
 
-[Events]
-Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
-"""
-    
-    ass_body = ""
-    
-    # 解析 SRT
-    # 简单的 SRT 解析器
-    blocks = re.split(r'\n\s*\n', srt_content.strip())
-    
-    for block in blocks:
-        lines = block.split('\n')
-        if len(lines) >= 3:
-            # line[0] 是序号
-            # line[1] 是时间轴
-            times = lines[1].split(' --> ')
-            if len(times) != 2: continue
-            
-            start_time = time_srt_to_ass(times[0].strip())
-            end_time = time_srt_to_ass(times[1].strip())
-            
-            # line[2:] 是文本
-            text = " ".join(lines[2:])
-            
-            # 判定角色
-            style = "Default"
-            if role_1_cn in text or "Ling" in text:
-                style = "LingStyle"
-            elif role_2_cn in text or "Orm" in text:
-                style = "OrmStyle"
-            
-            # 组装 Dialogue 行
-            ass_body += f"Dialogue: 0,{start_time},{end_time},{style},,0,0,0,,{text}\n"
+    gaps = []
+    cursor = 0.0
+    for span_start, span_end in covered + [(duration, duration)]:
+        if span_start - cursor >= FP_MIN_GAP_SECONDS:
+            gaps.append((cursor, span_start))
+        cursor = max(cursor, span_end)
+    return reused_cues, gaps
 
-    return ass_header + ass_body
+def store_fingerprint_job(hashes, settings_key, srt_text, db_path=FP_DB_PATH):
+    """
+    把本次任务的指纹和最终字幕写入索引，供以后的上传复用
+    同时按时间和数量清理旧任务，库不会无限增长
+    """
+    conn = _open_fingerprint_db(db_path)
+    try:
+        with conn:
+            job_id = conn.execute(
+                "INSERT INTO fp_jobs (settings_key, created, hashes, srt) VALUES (?, ?, ?, ?)",
+                (settings_key, time.time(), hashes.astype("<u4").tobytes(), srt_text)
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO fp_index (hash, job_id, frame) VALUES (?, ?, ?)",
+                ((h, job_id, frame) for frame, h in enumerate(hashes.tolist()) if h not in FP_SILENCE_HASHES)
+            )
 
-# --- 4. 辅助函数：字体下载与FFmpeg ---
+            stale = conn.execute(
+                """SELECT job_id FROM fp_jobs WHERE created < ?
+                   OR job_id NOT IN (SELECT job_id FROM fp_jobs ORDER BY created DESC LIMIT ?)""",
+                (time.time() - FP_MAX_AGE, FP_MAX_JOBS)
+            ).fetchall()
+            conn.executemany("DELETE FROM fp_index WHERE job_id = ?", stale)
+            conn.executemany("DELETE FROM fp_jobs WHERE job_id = ?", stale)
+    finally:
+        conn.close()
 
-def download_font_if_needed():
-    """下载开源中文字体防止乱码"""
-    font_path = "wqy-microhei.ttc"
-    if not os.path.exists(font_path):
-        url = "https://github.com/anthonyfok/fonts-wqy-microhei/raw/master/wqy-microhei.ttc" 
-        try:
-            r = requests.get(url, allow_redirects=True)
-            with open(font_path, 'wb') as f:
-                f.write(r.content)
-        except:
-            pass
-    return os.path.abspath(font_path)
+# --- 7. 异步任务中心：一个服务器级事件循环驱动所有会话的 ffmpeg / 模型调用 ---
+
+FFMPEG_CONCURRENCY = max(os.cpu_count() or 1, 1)  # 同时运行的 ffmpeg 进程数
+MODEL_CONCURRENCY = 32                            # 同时在途的模型请求数
+JOB_TTL = 2 * 60 * 60                             # 任务结束 2 小时后清理临时文件
+JOB_POLL_SECONDS = 1                              # 页面轮询任务进度的间隔
 
-def burn_ass_ffmpeg(video_path, ass_path, output_path, mode="soft"):
+class PipelineJob:
     """
-    mode="soft": 封装 ASS 流 (推荐，播放器可开关，有颜色，可提取编辑)
-    mode="hard": 硬烧录 (文字焊死在视频上，有颜色)
+    一个后台任务：状态在事件循环里更新 (每次整体替换 state)，页面定时读取 state 显示进度
+    files 里的临时文件在任务被丢弃或过期时删除
     """
-    video_abs_path = os.path.abspath(video_path)
-    ass_abs_path = os.path.abspath(ass_path).replace("\\", "/")
-    
-    if mode == "soft":
-        # 封装模式：MP4 容器可以容纳 ASS 流，但兼容性最好的其实是 MKV
-        # 为了剪映/手机兼容性，我们尝试封装进 MP4，如果不被识别，用户可以使用硬烧录
-        cmd = [
-            "ffmpeg", "-i", video_abs_path, "-i", ass_abs_path,
-            "-c", "copy", "-c:s", "mov_text", # MP4 标准容器不支持 ASS 样式流，只能转 mov_text (会丢失颜色)
-            # 这是一个技术两难：MP4软字幕很难带颜色。
-            # 为了“可编辑且带颜色”，我们推荐用户下载 .ASS 文件，
-            # 或者我们生成 MKV (支持彩色软字幕)，但用户可能要 MP4。
-            # 
-            # 策略调整：
-            # Soft 模式：生成 MKV (完美支持彩色软字幕)
-            # Hard 模式：生成 MP4 (烧录颜色)
-            "-map", "0", "-map", "1",
-            "-c:v", "copy", "-c:a", "copy", "-c:s", "ass", 
-            "-y", output_path.replace(".mp4", ".mkv") # 强制改后缀为 mkv 以支持样式
-        ]
-        final_output = output_path.replace(".mp4", ".mkv")
-        
-    else:
-        # 硬烧录模式
-        font_file = download_font_if_needed()
-        # 必须指定 fontsdir 否则 Linux 可能找不到字体
-        vf_cmd = f"subtitles='{ass_abs_path}':fontsdir='.'"
-        
-        cmd = [
-            "ffmpeg", "-i", video_abs_path, 
-            "-vf", vf_cmd,
-            "-c:a", "copy", 
-            "-c:v", "libx264", "-preset", "ultrafast", "-crf", "23",
-            "-y", output_path
-        ]
-        final_output = output_path
-    
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if result.returncode != 0:
-        raise Exception(f"FFmpeg Error: {result.stderr.decode('utf-8')}")
-    
-    return final_output
 
-# --- 5. 核心逻辑：智能模型 ---
+    def __init__(self, files=()):
+        self.job_id = uuid.uuid4().hex
+        self.state = {"stage": "⏳ Queued...", "percent": 0, "text": "", "done": False, "error": None}
+        self.result = {}
+        self.files = list(files)
+        self.task = None
+        self.finished_at = None
+        self.discarded = False
 
-def get_valid_flash_model(api_key):
-    genai.configure(api_key=api_key)
+    def update(self, **changes):
+        # 整体替换而不是原地修改，会话线程读到的总是一份完整的状态
+        self.state = {**self.state, **changes}
+
+    def cleanup(self):
+        for path in self.files:
+            if path and os.path.exists(path): os.remove(path)
+
+class PipelineHub:
+    """服务器级单例：拥有事件循环线程、并发限额和所有任务"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="pipeline-loop", daemon=True)
+        self.thread.start()
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+        async def make_semaphores():
+            # 信号量要在事件循环线程里创建
+            return asyncio.Semaphore(FFMPEG_CONCURRENCY), asyncio.Semaphore(MODEL_CONCURRENCY)
+        self.ffmpeg_slots, self.model_slots = asyncio.run_coroutine_threadsafe(make_semaphores(), self.loop).result()
+
+    def submit(self, job_coro, files=()):
+        """job_coro(job) -> 协程，返回值写入 job.result"""
+        self._purge_expired()
+        job = PipelineJob(files)
+        with self._lock:
+            self.jobs[job.job_id] = job
+
+        def finish(task):
+            if task.cancelled():
+                job.update(error="Cancelled", done=True)
+            elif task.exception() is not None:
+                job.update(error=str(task.exception()), done=True)
+            else:
+                job.result = task.result()
+                job.update(percent=100, done=True)
+            job.finished_at = time.time()
+            if job.discarded:
+                job.cleanup()
+
+        def start():
+            job.task = self.loop.create_task(job_coro(job))
+            job.task.add_done_callback(finish)
+
+        # 任务的创建、取消、收尾都在事件循环线程里按顺序执行，不需要额外加锁
+        self.loop.call_soon_threadsafe(start)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job:
+            self.loop.call_soon_threadsafe(lambda: job.task.cancel())
+
+    def discard(self, job_id):
+        """取消并删除任务及其临时文件 (会话开始新任务时丢弃旧的)"""
+        with self._lock:
+            job = self.jobs.pop(job_id, None)
+        if job is None:
+            return
+
+        def discard_on_loop():
+            job.discarded = True
+            if job.task.done():
+                job.cleanup()
+            else:
+                # 等任务真正停下 (ffmpeg 已被杀掉) 再由 finish 删文件
+                job.task.cancel()
+
+        self.loop.call_soon_threadsafe(discard_on_loop)
+
+    def _purge_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [job_id for job_id, job in self.jobs.items()
+                       if job.finished_at and now - job.finished_at > JOB_TTL]
+        for job_id in expired:
+            self.discard(job_id)
+
+@st.cache_resource
+def get_pipeline_hub():
+    return PipelineHub()
+
+def build_subtitle_prompt(role_1, role_2, role_1_cn, role_2_cn, blacklist):
+    # Prompt 强调格式
+    return f"""
+            Task: Transcribe and translate to Simplified Chinese Subtitles (SRT).
+            Context: Conversation between {role_1} and {role_2}.
+            Rules:
+            1. **IMPORTANT**: Start every dialogue line with "{role_1_cn}:" or "{role_2_cn}:".
+            2. "Phi Ling" -> "{role_1_cn}", "Nong Orm" -> "{role_2_cn}".
+            3. Tone: Sweet, romantic.
+            4. No words: {', '.join(blacklist)}.
+            5. Output ONLY valid SRT format.
+            """
+
+async def subtitle_job(job, hub, video_path, prompt, role_1_cn, role_2_cn, metrics):
+    """上传文件 -> 提取音频 -> 指纹复用 -> AI 生成字幕 -> 彩色 ASS"""
+    audio_path = video_path + ".mp3"
+    pcm_path = video_path + ".pcm"  # 同一次解码顺带输出原始 PCM，用于音频指纹
     try:
-        available_models = [m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
-        flash_models = [m for m in available_models if "flash" in m]
-        if not flash_models: return "gemini-1.5-flash"
-        flash_models.sort(key=len)
-        return flash_models[0]
-    except:
-        return "gemini-1.5-flash"
+        # 1. 提取音频
+        job.update(stage="🎧 Extracting Audio Stream...", percent=10)
 
-def generate_safe(file_obj, prompt, model_name):
-    for attempt in range(3):
-        try:
-            model = genai.GenerativeModel(model_name)
-            response = model.generate_content([file_obj, prompt], request_options={"timeout": 600})
-            return response.text
-        except Exception as e:
-            if "429" in str(e).lower():
-                time.sleep(10 * (attempt + 1))
-                continue
-            raise e
-    raise Exception("API Busy")
+        def on_extract_progress(info):
+            # 提取阶段占总进度条的 10% -> 30%
+            if info["percent"] is not None:
+                job.update(percent=10 + int(info["percent"] * 20), text=format_ffmpeg_progress("Extracting audio", info))
+
+        async with hub.ffmpeg_slots:
+            await run_ffmpeg(["-i", video_path, "-vn", "-ac", "1", "-ar", "16000", "-b:a", "32k", "-y", audio_path,
+                              "-vn", "-ac", "1", "-ar", str(FP_SAMPLE_RATE), "-f", "s16le", pcm_path],
+                             duration=await probe_duration(video_path), on_progress=on_extract_progress,
+                             timeout=AUDIO_EXTRACT_TIMEOUT)
+
+        # 2. 音频指纹：找出之前处理过的同一集片段，直接复用其字幕
+        job.update(stage="🔎 Matching Audio Fingerprint...", percent=30, text="")
+        valid_model = await asyncio.to_thread(get_valid_flash_model, API_KEY)
+        fp_hashes = await asyncio.to_thread(compute_fingerprint, pcm_path)
+        fp_key = fingerprint_settings_key(prompt, valid_model)
+        audio_duration = os.path.getsize(pcm_path) / 2 / FP_SAMPLE_RATE
+        reused_cues, gaps = await asyncio.to_thread(plan_fingerprint_reuse, fp_hashes, fp_key, audio_duration)
+        reused_seconds = audio_duration - sum(end - start for start, end in gaps) if reused_cues else 0.0
+
+        # 3. AI 生成字幕
+        job.update(stage="☁️ AI Listening & Translating...", percent=40)
+        if not reused_cues:
+            async with hub.model_slots:
+                subtitle_text = await transcribe_audio(audio_path, prompt, valid_model)
+        else:
+            # 只把未匹配的片段送去模型 (各片段并发)，时间轴平移回整段音频
+            async def transcribe_gap(start, end):
+                gap_path = f"{video_path}_gap_{start:.0f}.mp3"
+                try:
+                    async with hub.ffmpeg_slots:
+                        await run_ffmpeg(["-ss", f"{start:.3f}", "-to", f"{end:.3f}", "-i", audio_path, "-c", "copy", "-y", gap_path],
+                                         timeout=AUDIO_EXTRACT_TIMEOUT)
+                    async with hub.model_slots:
+                        gap_text = await transcribe_audio(gap_path, prompt, valid_model)
+                finally:
+                    if os.path.exists(gap_path): os.remove(gap_path)
+                return [(cue_start + start, min(cue_end + start, end), text)
+                        for cue_start, cue_end, text in parse_srt_cues(gap_text)]
+
+            # TaskGroup：一个片段失败时取消并等完其余片段，再删音频/释放名额，不留孤儿任务
+            try:
+                async with asyncio.TaskGroup() as group:
+                    gap_tasks = [group.create_task(transcribe_gap(start, end)) for start, end in gaps]
+            except ExceptionGroup as errors:
+                raise errors.exceptions[0]
+            cues = list(reused_cues)
+            for task in gap_tasks:
+                cues += task.result()
+            subtitle_text = format_srt_cues(sorted(cues))
+
+        if gaps or not reused_cues:
+            # 整段都是复用的就不再存一份 (库里已有同样的指纹和字幕)
+            await asyncio.to_thread(store_fingerprint_job, fp_hashes, fp_key, subtitle_text)
+
+        # 保存 SRT
+        srt_path = video_path + ".srt"
+        job.files.append(srt_path)
+        with open(srt_path, "w", encoding="utf-8") as f:
+            f.write(subtitle_text)
+
+        # 4. SRT 转 彩色 ASS
+        job.update(stage="🎨 Painting Subtitle Colors (Blue & Pink)...", percent=80)
+        play_res_x = ass_play_res_x(await probe_video_size(video_path))
+        ass_content = await asyncio.to_thread(convert_srt_to_ass_colored, subtitle_text, role_1_cn, role_2_cn,
+                                              metrics=metrics, play_res_x=play_res_x)
+        ass_path = video_path + ".ass"
+        job.files.append(ass_path)
+        with open(ass_path, "w", encoding="utf-8") as f:
+            f.write(ass_content)
+
+        return {"video_path": video_path, "ass_path": ass_path, "ass_content": ass_content,
+                "reused_ratio": reused_seconds / max(audio_duration, 1e-6)}
+    finally:
+        if os.path.exists(audio_path): os.remove(audio_path)
+        if os.path.exists(pcm_path): os.remove(pcm_path)
+
+async def render_job(job, hub, video_path, ass_path, mode, soft_formats=()):
+    """视频合成任务：mode="soft" 一次封装多个格式，mode="hard" 硬烧录 MP4"""
+    label = "Embedding subtitle streams" if mode == "soft" else "Rendering video"
+    job.update(stage=f"🎬 {label}...", text="")
+
+    def on_progress(info):
+        job.update(percent=int((info["percent"] or 0) * 100), text=format_ffmpeg_progress(label, info))
 
-# --- 6. 获取 API Key ---
+    async with hub.ffmpeg_slots:
+        if mode == "soft":
+            targets = {fmt: f"{video_path}_soft.{fmt}" for fmt in soft_formats}
+            job.files += targets.values()
+            outputs, errors = await mux_soft_subs(video_path, ass_path, targets, on_progress=on_progress, timeout=BURN_TIMEOUT)
+        else:
+            target_file = video_path + "_hard.mp4"
+            job.files.append(target_file)
+            outputs = {"mp4": await burn_ass_ffmpeg(video_path, ass_path, target_file, mode="hard",
+                                                    on_progress=on_progress, timeout=BURN_TIMEOUT)}
+            errors = {}
+    # errors: 没写出的格式及原因 (编码放不进 MP4 / 该格式单独报错)，界面上提示
+    return {"outputs": outputs, "errors": errors, "suffix": "soft" if mode == "soft" else "burned"}
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def show_job_progress(job_id):
+    """
+    定时只重跑这一小块来显示任务进度 (读 job.state，脚本本身立即返回，不占会话线程)
+    任务结束时整页重跑一次，由页面显示结果或错误
+    """
+    job = get_pipeline_hub().get(job_id)
+    if job is None:
+        return
+    state = job.state
+    if state["done"]:
+        st.rerun()
+    st.markdown(f"**{state['stage']}**")
+    st.progress(min(state["percent"], 100), text=state["text"])
+    if st.button("✖ Cancel", key=f"cancel_{job_id}"):
+        get_pipeline_hub().cancel(job_id)
+
+# --- 8. 获取 API Key ---
 try:
     API_KEY = st.secrets["GOOGLE_API_KEY"]
 except:
     API_KEY = None
 
-# --- 7. 界面构建 ---
+# --- 9. 界面构建 ---
 st.markdown("""
 <div class="hero-container">
     <div class="hero-title">LingOrm AI Studio</div>
@@ -652,120 +1322,90 @@ with st.container():
 
     st.markdown('</div>', unsafe_allow_html=True)
 
-# --- 8. 执行逻辑 ---
+# --- 10. 执行逻辑 ---
+# 任务跑在服务器事件循环里，会话只保存任务 ID：页面重跑 (点按钮/下载) 后可以重新接上进度和结果
+hub = get_pipeline_hub()
+
 if generate_btn and uploaded_file:
     if not API_KEY:
         st.error("🔒 Error: No API Key found in Secrets.")
     else:
-        status_msg = st.empty()
-        progress_bar = st.progress(0)
+        # 开始新任务时丢弃本会话的旧任务和旧文件
+        for key in ("subtitle_job", "render_job"):
+            if key in st.session_state:
+                hub.discard(st.session_state.pop(key))
+
+        # 1. 准备文件
+        with tempfile.NamedTemporaryFile(delete=False, suffix=Path(uploaded_file.name).suffix) as tmp_file:
+            tmp_file.write(uploaded_file.read())
+            tmp_video_path = tmp_file.name
+
+        configure_genai(API_KEY)
+        prompt = build_subtitle_prompt(role_1, role_2, role_1_cn, role_2_cn, blacklist)
+        metrics = get_font_metrics(download_font_if_needed(), ASS_FONT_SIZE)
+        job = hub.submit(
+            lambda job: subtitle_job(job, hub, tmp_video_path, prompt, role_1_cn, role_2_cn, metrics),
+            files=[tmp_video_path]
+        )
+        st.session_state["subtitle_job"] = job.job_id
+        st.session_state["upload_stem"] = Path(uploaded_file.name).stem
+
+job = hub.get(st.session_state.get("subtitle_job"))
+if job and not job.state["done"]:
+    show_job_progress(job.job_id)
+elif job:
+    if job.state["error"]:
+        st.error(f"❌ Error: {job.state['error']}")
+    else:
+        result = job.result
+        upload_stem = st.session_state.get("upload_stem", "subtitles")
+        ass_content = result["ass_content"]
+
+        # 4. 视频合成 UI
+        st.success("✅ Subtitles Generated! Choose Output Format below.")
+        if result["reused_ratio"] > 0:
+            st.caption(f"♻️ Reused {result['reused_ratio']:.0%} of the subtitles from an earlier upload of this episode.")
         
-        tmp_video_path = None
-        audio_path = None
-        srt_path = None
-        ass_path = None
-        final_video_path = None
+        st.markdown('<div class="clean-card">', unsafe_allow_html=True)
+        st.markdown("##### 🎬 Final Video Studio (Colored)")
         
-        try:
-            # 1. 准备文件
-            status_msg.markdown("**📂 Preparing Workspace...**")
-            with tempfile.NamedTemporaryFile(delete=False, suffix=Path(uploaded_file.name).suffix) as tmp_file:
-                tmp_file.write(uploaded_file.read())
-                tmp_video_path = tmp_file.name
-            
-            # 2. 提取音频
-            status_msg.markdown("**🎧 Extracting Audio Stream...**")
-            progress_bar.progress(10)
-            audio_path = tmp_video_path + ".mp3"
-            subprocess.run(["ffmpeg", "-i", tmp_video_path, "-vn", "-ac", "1", "-ar", "16000", "-b:a", "32k", "-y", audio_path], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-            # 3. AI 生成字幕
-            status_msg.markdown("**☁️ AI Listening & Translating...**")
-            progress_bar.progress(30)
-            
-            genai.configure(api_key=API_KEY)
-            video_file = genai.upload_file(path=audio_path)
-            while video_file.state.name == "PROCESSING":
-                time.sleep(2)
-                video_file = genai.get_file(video_file.name)
-            
-            # Prompt 强调格式
-            prompt = f"""
-            Task: Transcribe and translate to Simplified Chinese Subtitles (SRT).
-            Context: Conversation between {role_1} and {role_2}.
-            Rules:
-            1. **IMPORTANT**: Start every dialogue line with "{role_1_cn}:" or "{role_2_cn}:".
-            2. "Phi Ling" -> "{role_1_cn}", "Nong Orm" -> "{role_2_cn}".
-            3. Tone: Sweet, romantic.
-            4. No words: {', '.join(blacklist)}.
-            5. Output ONLY valid SRT format.
-            """
-            
-            valid_model = get_valid_flash_model(API_KEY)
-            subtitle_text = generate_safe(video_file, prompt, valid_model)
-            
-            # 保存 SRT
-            srt_path = tmp_video_path + ".srt"
-            with open(srt_path, "w", encoding="utf-8") as f:
-                f.write(subtitle_text)
-            
-            # --- 新增步骤：SRT 转 彩色 ASS ---
-            status_msg.markdown("**🎨 Painting Subtitle Colors (Blue & Pink)...**")
-            ass_content = convert_srt_to_ass_colored(subtitle_text, role_1_cn, role_2_cn)
-            ass_path = tmp_video_path + ".ass"
-            with open(ass_path, "w", encoding="utf-8") as f:
-                f.write(ass_content)
-
-            # 清理云端
-            try: video_file.delete()
-            except: pass
-            
-            # 4. 视频合成 UI
-            progress_bar.progress(80)
-            status_msg.success("✅ Subtitles Generated! Choose Output Format below.")
-            
-            st.markdown('<div class="clean-card">', unsafe_allow_html=True)
-            st.markdown("##### 🎬 Final Video Studio (Colored)")
-            
-            tab1, tab2 = st.tabs(["🌈 Colored Soft Subs (Editable)", "🔥 Hard Burn (Permanent)"])
-            
-            with tab1:
-                st.info("💡 **Recommended for Players**: Downloads an MKV video with embedded styled subtitles. You can turn them on/off, and colors will show in players like PotPlayer/VLC.")
-                st.text_area("ASS Content (Style Source)", ass_content, height=100)
-                
-                col_s1, col_s2 = st.columns(2)
-                with col_s1:
-                    st.download_button("📥 Download .ASS File", ass_content, f"{Path(uploaded_file.name).stem}.ass", "text/plain")
-                with col_s2:
-                    if st.button("🚀 Generate MKV (Soft Subs)"):
-                        try:
-                            with st.spinner("Embedding ASS stream..."):
-                                target_file = tmp_video_path + "_soft.mkv"
-                                real_output = burn_ass_ffmpeg(tmp_video_path, ass_path, target_file, mode="soft")
-                                with open(real_output, "rb") as v_file:
-                                    st.download_button("📥 Download Video (MKV)", v_file, f"{Path(uploaded_file.name).stem}_soft.mkv", "video/x-matroska")
-                        except Exception as e:
-                            st.error(f"Error: {e}")
+        tab1, tab2 = st.tabs(["🌈 Colored Soft Subs (Editable)", "🔥 Hard Burn (Permanent)"])
+        
+        with tab1:
+            st.info("💡 **Fast, no re-encoding**: MKV keeps the colored ASS styles (PotPlayer/VLC). MP4 plays everywhere (phones, CapCut) but its subtitle track is plain text. All selected formats are written in one pass.")
+            st.text_area("ASS Content (Style Source)", ass_content, height=100)
             
-            with tab2:
-                st.info("⚠️ **For Social Media**: Burns the colors permanently into the video. Text cannot be edited afterwards, but colors are guaranteed everywhere.")
-                if st.button("🔥 Hard Burn (MP4)"):
-                    try:
-                        with st.spinner("Rendering video (Slow)..."):
-                            target_file = tmp_video_path + "_hard.mp4"
-                            real_output = burn_ass_ffmpeg(tmp_video_path, ass_path, target_file, mode="hard")
-                            st.success("Render Complete!")
-                            with open(real_output, "rb") as v_file:
-                                st.download_button("📥 Download Video (MP4)", v_file, f"{Path(uploaded_file.name).stem}_burned.mp4", "video/mp4")
-                    except Exception as e:
-                        st.error(f"Render Failed: {e}")
-
-            st.markdown('</div>', unsafe_allow_html=True)
-            progress_bar.progress(100)
-
-        except Exception as e:
-            st.error(f"❌ Error: {str(e)}")
+            col_s1, col_s2 = st.columns(2)
+            with col_s1:
+                st.download_button("📥 Download .ASS File", ass_content, f"{upload_stem}.ass", "text/plain")
+            with col_s2:
+                soft_formats = st.multiselect("Formats", ["mkv", "mp4", "vtt"], default=["mkv", "mp4"])
+                soft_clicked = st.button("🚀 Generate Soft Subs") and soft_formats
         
-        finally:
-            if tmp_video_path and os.path.exists(tmp_video_path): os.remove(tmp_video_path)
-            if audio_path and os.path.exists(audio_path): os.remove(audio_path)
+        with tab2:
+            st.info("⚠️ **For Social Media**: Burns the colors permanently into the video. Text cannot be edited afterwards, but colors are guaranteed everywhere.")
+            hard_clicked = st.button("🔥 Hard Burn (MP4)")
+
+        if soft_clicked or hard_clicked:
+            if "render_job" in st.session_state:
+                hub.discard(st.session_state.pop("render_job"))
+            mode = "soft" if soft_clicked else "hard"
+            render = hub.submit(lambda render: render_job(render, hub, result["video_path"], result["ass_path"], mode, soft_formats))
+            st.session_state["render_job"] = render.job_id
+
+        render = hub.get(st.session_state.get("render_job"))
+        if render and not render.state["done"]:
+            show_job_progress(render.job_id)
+        elif render:
+            if render.state["error"]:
+                st.error(f"Render Failed: {render.state['error']}")
+            else:
+                st.success("Render Complete!")
+                for fmt, reason in render.result["errors"].items():
+                    st.warning(f"⚠️ Skipped {fmt.upper()}: {reason}")
+                mime_types = {"mkv": "video/x-matroska", "mp4": "video/mp4", "vtt": "text/vtt"}
+                for fmt, real_output in render.result["outputs"].items():
+                    with open(real_output, "rb") as v_file:
+                        st.download_button(f"📥 Download ({fmt.upper()})", v_file, f"{upload_stem}_{render.result['suffix']}.{fmt}", mime_types[fmt])
+
+        st.markdown('</div>', unsafe_allow_html=True)
@@ -0,0 +1,265 @@
+"""
+压测用的假 Gemini 服务 (不调用真实模型、不消耗配额)
+
+- gRPC (TLS)：GenerativeService.GenerateContent / ModelService.ListModels /
+  FileService.GetFile / FileService.DeleteFile，和 google-generativeai 的 gRPC 客户端直接对接
+- HTTP：File API 的 discovery 文档 + 断点续传上传接口 (SDK 上传文件走的是 REST)
+
+GenerateContent 按上传音频的大小估算时长 (32kbps mp3)，每 3 秒生成一句
+"角色名: 台词" 的 SRT，角色名取自 prompt；响应前按 --latency 随机等待。
+
+运行：
+    python tools/fake_gemini_server.py --port 50051 --http-port 8089
+
+启动后会打印需要导出的环境变量 (GEMINI_API_ENDPOINT / GRPC_DEFAULT_SSL_ROOTS_FILE_PATH /
+FAKE_GEMINI_DISCOVERY_URL)，设好后运行 tools/load_test.py 或 streamlit run app.py 即可，
+app.py 的 configure_genai 会把模型请求和文件上传都指向这里。
+需要 openssl 命令行生成自签名证书 (gRPC 客户端只走 TLS)。
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import re
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+import grpc
+from google.ai import generativelanguage_v1beta as glm
+from google.protobuf import empty_pb2
+
+SERVICE_PREFIX = "google.ai.generativelanguage.v1beta"
+FAKE_MODEL = "models/gemini-1.5-flash"
+MP3_BYTES_PER_SECOND = 32000 / 8   # app.py 提取音频用的是 32kbps
+CUE_SECONDS = 3.0
+
+uploaded_sizes = {}                # files/<id> -> 上传的字节数
+stats = collections.Counter()
+stats_lock = threading.Lock()
+
+def count(key):
+    with stats_lock:
+        stats[key] += 1
+
+def make_self_signed_cert(cert_dir):
+    """用 openssl 生成 localhost 的自签名证书，返回 (cert_path, key_path)"""
+    cert_path = os.path.join(cert_dir, "fake_gemini.crt")
+    key_path = os.path.join(cert_dir, "fake_gemini.key")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "7",
+         "-keyout", key_path, "-out", cert_path, "-subj", "/CN=localhost",
+         "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1"],
+        check=True, capture_output=True
+    )
+    return cert_path, key_path
+
+def fake_srt(duration, speakers):
+    """生成覆盖 duration 秒、两个角色交替说话的 SRT"""
+    def ts(seconds):
+        ms = int(round(seconds * 1000))
+        return f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d},{ms % 1000:03d}"
+    lines = [
+        "今天的天气真好，我们去海边走走吧。",
+        "好啊，不过要早点回来，晚上还有拍摄。",
+        "你是不是又忘了带外套？",
+        "没有忘，就在车上。",
+    ]
+    blocks = []
+    start, i = 0.5, 0
+    while start + 1.0 < duration:
+        end = min(start + CUE_SECONDS - 0.5, duration)
+        blocks.append(f"{i + 1}\n{ts(start)} --> {ts(end)}\n{speakers[i % 2]}: {lines[i % len(lines)]}\n")
+        start += CUE_SECONDS
+        i += 1
+    return "\n".join(blocks)
+
+def make_handlers(latency, busy_rate):
+    async def generate_content(request, context):
+        count("generate_content")
+        if random.random() < busy_rate:
+            count("generate_content_429")
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, "Quota exceeded (fake)")
+        await asyncio.sleep(random.uniform(*latency))
+
+        prompt = "".join(part.text for content in request.contents for part in content.parts)
+        speakers = re.findall(r'with "([^"]+?):" or "([^"]+?):"', prompt)
+        speakers = list(speakers[0]) if speakers else ["A", "B"]
+        # file_uri 形如 https://fake-gemini.local/v1beta/files/<id>
+        file_names = [part.file_data.file_uri.partition("/v1beta/")[2] for content in request.contents
+                      for part in content.parts if part.file_data.file_uri]
+        size = uploaded_sizes.get(file_names[0], 0) if file_names else 0
+        duration = max(size / MP3_BYTES_PER_SECOND, CUE_SECONDS)
+
+        return glm.GenerateContentResponse(candidates=[glm.Candidate(
+            content=glm.Content(role="model", parts=[glm.Part(text=fake_srt(duration, speakers))]),
+            finish_reason=glm.Candidate.FinishReason.STOP,
+        )])
+
+    async def list_models(request, context):
+        count("list_models")
+        return glm.ListModelsResponse(models=[glm.Model(
+            name=FAKE_MODEL, display_name="Fake Flash", supported_generation_methods=["generateContent"]
+        )])
+
+    async def get_file(request, context):
+        count("get_file")
+        if request.name not in uploaded_sizes:
+            await context.abort(grpc.StatusCode.NOT_FOUND, f"{request.name} not found")
+        return glm.File(name=request.name, uri=f"https://fake-gemini.local/v1beta/{request.name}",
+                        mime_type="audio/mpeg", size_bytes=uploaded_sizes[request.name],
+                        state=glm.File.State.ACTIVE)
+
+    async def delete_file(request, context):
+        count("delete_file")
+        uploaded_sizes.pop(request.name, None)
+        return empty_pb2.Empty()
+
+    def unary(fn, request_type, response_serializer):
+        return grpc.unary_unary_rpc_method_handler(
+            fn, request_deserializer=request_type.deserialize, response_serializer=response_serializer
+        )
+
+    return [
+        grpc.method_handlers_generic_handler(f"{SERVICE_PREFIX}.GenerativeService", {
+            "GenerateContent": unary(generate_content, glm.GenerateContentRequest, glm.GenerateContentResponse.serialize),
+        }),
+        grpc.method_handlers_generic_handler(f"{SERVICE_PREFIX}.ModelService", {
+            "ListModels": unary(list_models, glm.ListModelsRequest, glm.ListModelsResponse.serialize),
+        }),
+        grpc.method_handlers_generic_handler(f"{SERVICE_PREFIX}.FileService", {
+            "GetFile": unary(get_file, glm.GetFileRequest, glm.File.serialize),
+            "DeleteFile": unary(delete_file, glm.DeleteFileRequest, empty_pb2.Empty.SerializeToString),
+        }),
+    ]
+
+def discovery_doc(root_url):
+    """File API 上传只用到 media.upload，这里只描述这一个方法"""
+    return {
+        "kind": "discovery#restDescription", "discoveryVersion": "v1",
+        "id": "generativelanguage:v1beta", "name": "generativelanguage", "version": "v1beta",
+        "rootUrl": root_url, "servicePath": "", "baseUrl": root_url, "batchPath": "batch",
+        "protocol": "rest",
+        "parameters": {"key": {"type": "string", "location": "query"}},
+        "schemas": {
+            "CreateFileRequest": {"id": "CreateFileRequest", "type": "object",
+                                  "properties": {"file": {"type": "object"}}},
+            "CreateFileResponse": {"id": "CreateFileResponse", "type": "object",
+                                   "properties": {"file": {"type": "object"}}},
+        },
+        "resources": {"media": {"methods": {"upload": {
+            "id": "generativelanguage.media.upload", "path": "v1beta/files", "flatPath": "v1beta/files",
+            "httpMethod": "POST", "parameters": {}, "parameterOrder": [],
+            "request": {"$ref": "CreateFileRequest"}, "response": {"$ref": "CreateFileResponse"},
+            "supportsMediaUpload": True,
+            "mediaUpload": {"accept": ["*/*"], "protocols": {
+                "simple": {"multipart": True, "path": "/upload/v1beta/files"},
+                "resumable": {"multipart": True, "path": "/upload/v1beta/files"},
+            }},
+        }}}},
+    }
+
+def make_http_handler(root_url):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, status, body=b"", headers=()):
+            self.send_response(status)
+            for key, value in headers:
+                self.send_header(key, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _read_body(self):
+            return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+        def do_GET(self):
+            # httplib2 会把 "$" 编码成 %24
+            if unquote(urlparse(self.path).path) == "/$discovery/rest":
+                count("discovery")
+                body = json.dumps(discovery_doc(root_url)).encode("utf-8")
+                self._reply(200, body, [("Content-Type", "application/json")])
+            else:
+                self._reply(404)
+
+        def do_POST(self):
+            # 断点续传第一步：返回上传地址
+            self._read_body()
+            # googleapiclient 把上传地址拼成 rootUrl + "upload/" + path，uploadType 放在查询参数里
+            if urlparse(self.path).path == "/upload/v1beta/files":
+                session = uuid.uuid4().hex[:16]
+                self._reply(200, headers=[("Location", f"{root_url}upload-session/{session}")])
+            else:
+                self._reply(404)
+
+        def do_PUT(self):
+            path = urlparse(self.path).path
+            if not path.startswith("/upload-session/"):
+                self._reply(404)
+                return
+            data = self._read_body()
+            count("upload")
+            name = f"files/{path.rsplit('/', 1)[-1]}"
+            uploaded_sizes[name] = len(data)
+            body = json.dumps({"file": {"name": name, "mimeType": "audio/mpeg",
+                                        "sizeBytes": str(len(data)), "state": "ACTIVE"}}).encode("utf-8")
+            self._reply(200, body, [("Content-Type", "application/json")])
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+async def serve(args):
+    cert_dir = args.cert_dir or tempfile.mkdtemp(prefix="fake_gemini_")
+    cert_path, key_path = make_self_signed_cert(cert_dir)
+    with open(cert_path, "rb") as f:
+        cert = f.read()
+    with open(key_path, "rb") as f:
+        key = f.read()
+
+    root_url = f"http://127.0.0.1:{args.http_port}/"
+    http_server = ThreadingHTTPServer(("127.0.0.1", args.http_port), make_http_handler(root_url))
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+
+    server = grpc.aio.server()
+    server.add_generic_rpc_handlers(make_handlers(tuple(args.latency), args.busy_rate))
+    server.add_secure_port(f"localhost:{args.port}", grpc.ssl_server_credentials([(key, cert)]))
+    await server.start()
+
+    print("Fake Gemini server is running. Export these before starting the app / load test:")
+    print(f"  export GEMINI_API_ENDPOINT=localhost:{args.port}")
+    print(f"  export GRPC_DEFAULT_SSL_ROOTS_FILE_PATH={cert_path}")
+    print(f"  export FAKE_GEMINI_DISCOVERY_URL={root_url}$discovery/rest")
+    try:
+        while True:
+            await asyncio.sleep(args.stats_every)
+            with stats_lock:
+                print(time.strftime("%H:%M:%S"), dict(stats), flush=True)
+    finally:
+        http_server.shutdown()
+        await server.stop(None)
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Gemini backend for load testing app.py")
+    parser.add_argument("--port", type=int, default=50051, help="gRPC (TLS) port for GEMINI_API_ENDPOINT")
+    parser.add_argument("--http-port", type=int, default=8089, help="HTTP port for discovery + file uploads")
+    parser.add_argument("--latency", type=float, nargs=2, default=[1.0, 3.0], metavar=("MIN", "MAX"),
+                        help="GenerateContent latency range in seconds")
+    parser.add_argument("--busy-rate", type=float, default=0.0, help="fraction of GenerateContent calls answered with 429")
+    parser.add_argument("--cert-dir", default=None, help="where to write the self-signed cert (default: temp dir)")
+    parser.add_argument("--stats-every", type=float, default=10.0, help="print request counters every N seconds")
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
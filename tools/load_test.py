@@ -0,0 +1,144 @@
+"""
+app.py 的并发压测：一个进程里同时提交 N 个字幕任务 (相当于 N 个会话同时点 Generate)，
+全部走 PipelineHub 的事件循环，模型请求打到 GEMINI_API_ENDPOINT
+
+配合假模型服务运行：
+    python tools/fake_gemini_server.py --latency 1 3        # 按提示导出三个环境变量
+    python tools/load_test.py --jobs 50                     # 用 ffmpeg 生成的 60 秒样片
+    python tools/load_test.py --jobs 20 --media episode.mp4 --render soft
+
+输出总耗时、单任务耗时 p50/p95/max、事件循环最大卡顿、峰值线程数和失败数。
+指向真实/预发环境时不设 FAKE_GEMINI_DISCOVERY_URL，并用 GOOGLE_API_KEY 提供密钥。
+需要 ffmpeg/ffprobe 在 PATH 上；指纹库和临时文件写在一个临时目录里，结束后删除。
+"""
+import argparse
+import asyncio
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+def load_app():
+    """以 bare mode 导入 app.py (页面部分的 st 调用都是空操作)，只用它的任务函数"""
+    # bare mode 下每个 st 调用都会警告缺少 ScriptRunContext
+    # (先解析一次配置，否则解析时会把日志级别重置成配置里的 info)
+    import streamlit.config
+    import streamlit.logger
+    streamlit.config.get_config_options()
+    streamlit.logger.set_log_level("error")
+    sys.path.insert(0, str(ROOT))
+    import app
+    app.API_KEY = os.environ.get("GOOGLE_API_KEY", "fake-key")
+    return app
+
+def make_sample_media(workdir, seconds):
+    """生成一段带噪声音轨的测试视频"""
+    path = os.path.join(workdir, "sample.mp4")
+    subprocess.run([
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size=640x360:rate=25:duration={seconds}",
+        "-f", "lavfi", "-i", f"anoisesrc=color=pink:amplitude=0.2:duration={seconds}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac", "-shortest", "-y", path
+    ], check=True)
+    return path
+
+async def measure_loop_lag(stop, interval=0.05):
+    """事件循环被同步代码卡住时，sleep 会明显超时；返回最大超时 (秒)"""
+    worst = 0.0
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - started - interval)
+    return worst
+
+def wait_all(jobs, peak_threads):
+    while not all(job.state["done"] for job, _ in jobs):
+        peak_threads = max(peak_threads, threading.active_count())
+        time.sleep(0.05)
+    return peak_threads
+
+def report(name, jobs, elapsed):
+    latencies = sorted(job.finished_at - submitted for job, submitted in jobs)
+    errors = [job.state["error"] for job, _ in jobs if job.state["error"]]
+    def pct(p):
+        return latencies[min(int(p * len(latencies)), len(latencies) - 1)]
+    print(f"{name}: {len(jobs)} jobs in {elapsed:.1f}s · "
+          f"latency p50 {pct(0.5):.1f}s / p95 {pct(0.95):.1f}s / max {latencies[-1]:.1f}s · "
+          f"errors {len(errors)}")
+    for error in sorted(set(errors))[:5]:
+        print(f"  ! {error.splitlines()[0] if error else error}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent subtitle-job load test for app.py")
+    parser.add_argument("--jobs", type=int, default=20, help="number of concurrent uploads")
+    parser.add_argument("--media", default=None, help="media file to upload (default: generated sample)")
+    parser.add_argument("--seconds", type=int, default=60, help="length of the generated sample")
+    parser.add_argument("--render", choices=["soft", "hard"], default=None, help="also render every result")
+    parser.add_argument("--font", default=None, help="font file for layout metrics (default: width estimate)")
+    args = parser.parse_args()
+
+    if not os.environ.get("GEMINI_API_ENDPOINT"):
+        print("GEMINI_API_ENDPOINT is not set: requests would go to the real Gemini API.", file=sys.stderr)
+        sys.exit(2)
+
+    app = load_app()
+    workdir = tempfile.mkdtemp(prefix="lingorm_load_")
+    media = os.path.abspath(args.media) if args.media else None
+    os.chdir(workdir)  # 指纹库 (相对路径) 也落在临时目录
+    try:
+        if media is None:
+            media = make_sample_media(workdir, args.seconds)
+
+        app.configure_genai(app.API_KEY)
+        hub = app.PipelineHub()
+        metrics = app.FontMetrics(args.font, app.ASS_FONT_SIZE)
+        prompt = app.build_subtitle_prompt("Ling", "Orm", "Ling姐", "Orm", [])
+
+        stop = threading.Event()
+        lag = asyncio.run_coroutine_threadsafe(measure_loop_lag(stop), hub.loop)
+
+        uploads = []
+        for i in range(args.jobs):
+            video_path = os.path.join(workdir, f"upload_{i}{Path(media).suffix}")
+            shutil.copyfile(media, video_path)
+            uploads.append(video_path)
+
+        peak_threads = threading.active_count()
+        started = time.time()
+        jobs = [(hub.submit(lambda job, path=path: app.subtitle_job(job, hub, path, prompt, "Ling姐", "Orm", metrics),
+                            files=[path]), time.time())
+                for path in uploads]
+        peak_threads = wait_all(jobs, peak_threads)
+        report("subtitle", jobs, time.time() - started)
+
+        renders = []
+        if args.render:
+            started = time.time()
+            renders = [(hub.submit(lambda render, result=job.result: app.render_job(
+                            render, hub, result["video_path"], result["ass_path"], args.render, ["mkv", "mp4"])),
+                        time.time())
+                       for job, _ in jobs if not job.state["error"]]
+            if renders:
+                peak_threads = wait_all(renders, peak_threads)
+                report(f"render ({args.render})", renders, time.time() - started)
+
+        stop.set()
+        print(f"event loop max lag {lag.result() * 1000:.0f} ms · peak threads {peak_threads}")
+
+        for job, _ in jobs + renders:
+            hub.discard(job.job_id)
+        time.sleep(0.5)  # 让 discard 在事件循环里删完文件
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()